@@ -0,0 +1,53 @@
+import glob
+import os
+import re
+from collections.abc import Sequence
+
+
+def document_id(file_path):
+    """Numeric id in a file name such as News12.txt or d12.txt."""
+    return re.search(r"\d+", os.path.basename(file_path)).group()
+
+
+def list_documents(directory, pattern="News*.txt"):
+    """Paths of the matching files in directory, ordered by numeric id."""
+    return sorted(
+        glob.glob(os.path.join(directory, pattern)),
+        key=lambda x: int(document_id(x)),
+    )
+
+
+def iter_documents(file_paths, skip_empty=True):
+    """Lazily yield (doc_id, path, text) for each file, one file at a time.
+
+    Nothing is read ahead, so a consumer that processes documents in bounded
+    chunks never holds more than its current chunk of raw text.
+    """
+    for file_path in file_paths:
+        try:
+            with open(file_path, "r", encoding="utf-8") as file:
+                content = file.read().strip()
+        except Exception as e:
+            print(f"Error reading {file_path}: {e}")
+            continue
+
+        if content or not skip_empty:
+            yield document_id(file_path), file_path, content
+        else:
+            print(f"Warning: Empty document {file_path} skipped.")
+
+
+class LazyDocuments(Sequence):
+    """Read-on-demand list of document texts backed by their file paths."""
+
+    def __init__(self, file_paths):
+        self.file_paths = file_paths
+
+    def __len__(self):
+        return len(self.file_paths)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return LazyDocuments(self.file_paths[index])
+        with open(self.file_paths[index], "r", encoding="utf-8") as file:
+            return file.read().strip()
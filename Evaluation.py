@@ -1,47 +1,93 @@
 import os
-import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from nltk.corpus import stopwords
-from nltk.stem import PorterStemmer
 from collections import defaultdict
+from functools import lru_cache
 import numpy as np
-from tqdm import tqdm
 import re
-
-# Initialize stemmer and stop words
-ps = PorterStemmer()
-stop_words = set(stopwords.words("english"))
+from DocumentLoader import iter_documents, list_documents
+from Instrumentation import QUIET_ENV, envFlag
+import util
+
+# pandas, scikit-learn, nltk and tqdm are imported inside the functions that
+# use them, so importing this module (e.g. for the metrics) stays cheap.
+
+
+@lru_cache(maxsize=None)
+def _text_preprocessor():
+    """NLTK Porter stemmer and English stop words, loaded on first use."""
+    from nltk.corpus import stopwords
+    from nltk.stem import PorterStemmer
+
+    return PorterStemmer(), frozenset(stopwords.words("english"))
+
+
+def _numeric_id(text):
+    """Numeric part of an id such as q12, d12 or 12."""
+    match = re.search(r"\d+", text)
+    return match.group() if match else text
+
+
+def load_graded_qrels(filepath):
+    """Parse relevance judgments into {query_id: {doc_id: grade}}.
+
+    Two line formats are accepted and may be mixed:
+      - rel.tsv:  "q0<TAB>[27, 34, 37]"  (every listed doc has grade 1)
+      - TREC:     "q0 0 d27 2"          (query, iteration, doc, grade)
+    Ids are reduced to their numeric part, as in the collection file names.
+    Nothing is eval'd.
+    """
+    qrels = defaultdict(dict)
+    with open(filepath, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            if "[" in line:
+                query_id, doc_ids = line.split(None, 1)
+                grades = qrels[_numeric_id(query_id)]
+                for doc_id in re.findall(r"\d+", doc_ids):
+                    grades[doc_id] = 1
+                continue
+
+            fields = line.split()
+            if len(fields) != 4:
+                raise ValueError(f"{filepath}:{line_number}: unrecognised qrels line")
+            query_id, _, doc_id, grade = fields
+            qrels[_numeric_id(query_id)][_numeric_id(doc_id)] = int(grade)
+
+    return dict(qrels)
+
+
+def load_qrels(filepath, min_relevance=1):
+    """Relevant doc ids per query: {query_id: frozenset(doc_ids)}.
+
+    A document counts as relevant when its grade is at least min_relevance.
+    """
+    return {
+        query_id: frozenset(
+            doc_id for doc_id, grade in grades.items() if grade >= min_relevance
+        )
+        for query_id, grades in load_graded_qrels(filepath).items()
+    }
 
 
 def load_relevance_data(filepath):
-    rel_data = {}
-    with open(filepath, "r") as f:
-        for line in f:
-            query_id, doc_ids = line.strip().split("\t")
-            # Extract just the numeric parts of the IDs
-            query_id = re.search(r"\d+", query_id).group()
-            doc_ids = eval(doc_ids)
-            # Convert document IDs to just numbers
-            doc_ids = [re.search(r"\d+", str(doc_id)).group() for doc_id in doc_ids]
-            rel_data[query_id] = doc_ids
+    """Relevance judgments as a (QueryID, DocID, Relevance) DataFrame."""
+    import pandas as pd
 
     rel_data_list = [
-        (query_id, doc_id, 1)
-        for query_id, doc_ids in rel_data.items()
-        for doc_id in doc_ids
+        (query_id, doc_id, grade)
+        for query_id, grades in load_graded_qrels(filepath).items()
+        for doc_id, grade in grades.items()
     ]
     return pd.DataFrame(rel_data_list, columns=["QueryID", "DocID", "Relevance"])
 
 
 def load_documents(collection_path):
-    documents = {}
-    for filename in os.listdir(collection_path):
-        # Extract just the numeric ID from filename
-        doc_id = re.search(r"\d+", filename).group()
-        with open(os.path.join(collection_path, filename), "r", encoding="utf-8") as f:
-            documents[doc_id] = f.read().lower()  # Convert to lowercase
-    return documents
+    """Lazily yield (doc_id, text) for every collection file, lowercased."""
+    file_paths = list_documents(collection_path, pattern="*")
+    for doc_id, _, text in iter_documents(file_paths, skip_empty=False):
+        yield doc_id, text.lower()  # Convert to lowercase
 
 
 def load_queries(queries_path):
@@ -55,6 +101,7 @@ def load_queries(queries_path):
 
 
 def preprocess_text(text):
+    ps, stop_words = _text_preprocessor()
     # Remove punctuation and convert to lowercase
     text = re.sub(r"[^\w\s]", "", text.lower())
     tokens = text.split()
@@ -63,26 +110,71 @@ def preprocess_text(text):
     return " ".join(processed_tokens)
 
 
-def compute_cosine_similarity(query, documents):
-    # Create a list of all documents plus the query, maintaining the order
-    doc_ids = list(documents.keys())
-    texts = [documents[doc_id] for doc_id in doc_ids] + [query]
+def fit_document_index(documents):
+    """Fit TF-IDF on the collection once.
+
+    Returns (doc_ids, vectorizer, tfidf_matrix); queries are later only
+    transformed with the fitted vectorizer, never refitted.
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
 
-    # Compute TF-IDF and cosine similarity
+    doc_ids = list(documents.keys())
     vectorizer = TfidfVectorizer()
-    tfidf_matrix = vectorizer.fit_transform(texts)
-    cosine_sim = cosine_similarity(tfidf_matrix[-1:], tfidf_matrix[:-1])
+    tfidf_matrix = vectorizer.fit_transform(documents[doc_id] for doc_id in doc_ids)
+    return doc_ids, vectorizer, tfidf_matrix
+
+
+def rank_documents(queries, doc_ids, vectorizer, tfidf_matrix, k=10):
+    """Rank the collection for a batch of preprocessed queries.
+
+    All queries are transformed and scored against the fitted document
+    matrix in one product. Returns the top-k doc ids of each query, in order.
+    """
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    query_matrix = vectorizer.transform(queries)
+    similarities = cosine_similarity(query_matrix, tfidf_matrix)
+    return [[doc_ids[i] for i in util.top_k(row, k)] for row in similarities]
 
-    # Return similarities with their corresponding document IDs
-    similarities = [(doc_id, sim) for doc_id, sim in zip(doc_ids, cosine_sim[0])]
-    return similarities
+
+def rank_with_vector_space(
+    queries, collections_path, weighting, k=10, quiet=None, **params
+):
+    """Rank the collection with VectorSpace and one of its weightings.
+
+    params override VectorSpace.rankingParameters (k1, b, delta, slope);
+    unknown ones raise ValueError before the collection is read. quiet is
+    passed on to the VectorSpace.
+    Returns (doc_ids, rankings, parameters): doc_ids and rankings like
+    fit_document_index/rank_documents, and the ranking parameters used
+    (empty for tf and tf-idf, which have none).
+    """
+    from VectorSpace import RANKING_FUNCTIONS, VectorSpace
+
+    doc_ids = []
+
+    def texts():
+        for doc_id, text in load_documents(collections_path):
+            doc_ids.append(doc_id)
+            yield text
+
+    vector_space = VectorSpace(language="english", quiet=quiet)
+    vector_space.setRankingParameters(**params)
+    vector_space.build(texts())
+    results = vector_space.search_batch(queries, "cosine", weighting, k)
+    rankings = [[doc_ids[index] for index, _ in top] for top in results]
+    parameters = (
+        dict(vector_space.rankingParameters) if weighting in RANKING_FUNCTIONS else {}
+    )
+    return doc_ids, rankings, parameters
 
 
 def calculate_metrics_at_k(relevant_docs, ranked_docs, k=10):
     if not relevant_docs:
         return 0, 0, 0
 
-    relevant_docs = set(relevant_docs)
+    if not isinstance(relevant_docs, (set, frozenset)):
+        relevant_docs = set(relevant_docs)
     ranked_docs = ranked_docs[:k]
 
     # MRR@k
@@ -108,37 +200,71 @@ def calculate_metrics_at_k(relevant_docs, ranked_docs, k=10):
     return mrr, map_score, recall
 
 
-def evaluate_ir_system(queries_path, collections_path, rel_file):
-    print("Loading data...")
-    relevance_data = load_relevance_data(rel_file)
-    documents = load_documents(collections_path)
+def evaluate_ir_system(
+    queries_path, collections_path, rel_file, weighting=None, quiet=None, **params
+):
+    """Print and return MRR@10, MAP@10 and Recall@10 over all queries.
+
+    By default the collection is ranked with scikit-learn TF-IDF. With a
+    weighting ("tf", "tf-idf", "bm25", "bm25+" or "pivoted") it is ranked by
+    VectorSpace instead, with params overriding its ranking parameters; for
+    "bm25", "bm25+" and "pivoted" the parameters used are returned under
+    "parameters". quiet (or VSM_QUIET=1) silences the progress bars and
+    messages; the summary is still printed.
+    """
+    from tqdm import tqdm
+
+    if params and weighting is None:
+        raise ValueError("Ranking parameters need a VectorSpace weighting")
+    quiet = envFlag(QUIET_ENV) if quiet is None else quiet
+    log = (lambda message: None) if quiet else print
+    log("Loading data...")
+    qrels = load_qrels(rel_file)
     queries = load_queries(queries_path)
-
-    # Preprocess all documents once
-    print("Preprocessing documents...")
-    docs_preprocessed = {
-        doc_id: preprocess_text(text)
-        for doc_id, text in tqdm(documents.items(), desc="Preprocessing")
-    }
+    query_ids = list(queries.keys())
+
+    if weighting is not None:
+        log(f"Ranking queries with {weighting}...")
+        doc_ids, rankings, parameters = rank_with_vector_space(
+            [queries[query_id] for query_id in query_ids],
+            collections_path,
+            weighting,
+            quiet=quiet,
+            **params,
+        )
+    else:
+        # Preprocess all documents once, reading them one at a time
+        log("Preprocessing documents...")
+        docs_preprocessed = {
+            doc_id: preprocess_text(text)
+            for doc_id, text in tqdm(
+                load_documents(collections_path), desc="Preprocessing", disable=quiet
+            )
+        }
+
+        # Fit the document index once, then rank every query in one batch
+        log("Indexing documents...")
+        doc_ids, vectorizer, tfidf_matrix = fit_document_index(docs_preprocessed)
+
+        log("Ranking queries...")
+        rankings = rank_documents(
+            [preprocess_text(queries[query_id]) for query_id in query_ids],
+            doc_ids,
+            vectorizer,
+            tfidf_matrix,
+        )
 
     results = defaultdict(list)
-    print("Processing queries and calculating metrics...")
-
-    for query_id, query_text in tqdm(queries.items(), desc="Evaluating Queries"):
+    log("Calculating metrics...")
+
+    for query_id, ranked_docs in tqdm(
+        zip(query_ids, rankings),
+        total=len(query_ids),
+        desc="Evaluating Queries",
+        disable=quiet,
+    ):
         # Get relevant documents for this query
-        relevant_docs = relevance_data[relevance_data["QueryID"] == query_id][
-            "DocID"
-        ].tolist()
-
-        # Preprocess query
-        query_preprocessed = preprocess_text(query_text)
-
-        # Compute similarities and rank documents
-        similarities = compute_cosine_similarity(query_preprocessed, docs_preprocessed)
-        ranked_docs = [
-            doc_id
-            for doc_id, _ in sorted(similarities, key=lambda x: x[1], reverse=True)
-        ]
+        relevant_docs = qrels.get(query_id, frozenset())
 
         # Calculate metrics
         mrr, map_score, recall = calculate_metrics_at_k(relevant_docs, ranked_docs)
@@ -150,10 +276,16 @@ def evaluate_ir_system(queries_path, collections_path, rel_file):
     # Print summary with more detail
     print("\nTask4: Evaluation IR System")
     print(f"Number of queries processed: {len(queries)}")
-    print(f"Number of documents in collection: {len(documents)}")
-    print(f"MRR@10: {np.mean(results['MRR@10']):.4f}")
-    print(f"MAP@10: {np.mean(results['MAP@10']):.4f}")
-    print(f"Recall@10: {np.mean(results['Recall@10']):.4f}")
+    print(f"Number of documents in collection: {len(doc_ids)}")
+    if weighting is not None:
+        settings = " ".join(f"{name}={value}" for name, value in parameters.items())
+        print(f"Weighting: {weighting} {settings}".rstrip())
+    metrics = {name: float(np.mean(values)) for name, values in results.items()}
+    for name, value in metrics.items():
+        print(f"{name}: {value:.4f}")
+    if weighting is not None and parameters:
+        metrics["parameters"] = parameters
+    return metrics
 
 
 # File paths
@@ -0,0 +1,216 @@
+import cProfile
+import bisect
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Environment switches, so a run can be instrumented without code changes
+PROFILE_ENV = "VSM_PROFILE"
+TRACE_MEMORY_ENV = "VSM_TRACE_MEMORY"
+QUIET_ENV = "VSM_QUIET"
+
+# Functions and allocation sites kept per profile or memory snapshot
+REPORT_TOP = 20
+
+# Upper bounds in seconds of the LatencyHistogram buckets, 50 µs to ~52 s
+LATENCY_BUCKETS = tuple(0.00005 * 2**exponent for exponent in range(21))
+
+
+def envFlag(name):
+    """True if the environment variable is set to anything but 0/false/empty"""
+    return os.environ.get(name, "").strip().lower() not in ("", "0", "false", "no")
+
+
+def peakRss():
+    """Peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports KiB
+
+
+class Instrumentation:
+    """Per-phase timers, counters, memory peaks and optional cProfile capture.
+
+    Timers and counters are always on and cost a perf_counter call per
+    phase. tracemalloc (traceMemory) and cProfile (profile) are opt-in, as
+    arguments or through VSM_TRACE_MEMORY and VSM_PROFILE. Everything is
+    collected into report(), which is plain JSON.
+    """
+
+    def __init__(self, profile=None, traceMemory=None):
+        self.profile = envFlag(PROFILE_ENV) if profile is None else profile
+        self.traceMemory = (
+            envFlag(TRACE_MEMORY_ENV) if traceMemory is None else traceMemory
+        )
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        self.phases = {}
+        self.counts = {}
+        self.memory = {}
+        self.profilers = {}
+        self.activeProfile = None
+        self.openPeaks = []  # Traced peak so far of each open phase, outermost first
+
+    @contextmanager
+    def phase(self, name):
+        """Time the with-block, adding to the totals of phase name.
+
+        Phases nest. With traceMemory, each phase's traced peak covers its
+        nested phases too: the global tracemalloc peak is folded into every
+        open phase before a nested phase resets it.
+        """
+        if self.traceMemory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.foldPeak()
+            tracemalloc.reset_peak()
+            self.openPeaks.append(tracemalloc.get_traced_memory()[0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            totals = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+            totals["seconds"] += seconds
+            totals["calls"] += 1
+            totals["peak_rss_bytes"] = peakRss()
+            if self.traceMemory:
+                self.foldPeak()
+                self.recordMemory(name, self.openPeaks.pop())
+
+    def foldPeak(self):
+        """Raise the peak of every open phase to the current tracemalloc peak"""
+        peak = tracemalloc.get_traced_memory()[1]
+        self.openPeaks = [max(openPeak, peak) for openPeak in self.openPeaks]
+
+    def recordMemory(self, name, peak):
+        """Store the tracemalloc peak and top allocation sites of a phase"""
+        current = tracemalloc.get_traced_memory()[0]
+        statistics = tracemalloc.take_snapshot().statistics("lineno")[:REPORT_TOP]
+        self.memory[name] = {
+            "traced_bytes": current,
+            "traced_peak_bytes": max(
+                peak, self.memory.get(name, {}).get("traced_peak_bytes", 0)
+            ),
+            "top_allocations": [
+                {"site": str(stat.traceback), "bytes": stat.size, "blocks": stat.count}
+                for stat in statistics
+            ],
+        }
+
+    @contextmanager
+    def profiled(self, name):
+        """Run the with-block under cProfile if profiling is enabled.
+
+        Calls with the same name share one profiler, so their statistics add
+        up. Nested profiled blocks only profile the outermost one.
+        """
+        if not self.profile or self.activeProfile is not None:
+            yield
+            return
+        profiler = self.profilers.setdefault(name, cProfile.Profile())
+        self.activeProfile = name
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.activeProfile = None
+
+    def count(self, name, value=1):
+        """Add value to counter name"""
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def profileReport(self, name):
+        """The REPORT_TOP functions of a profile by cumulative time"""
+        stats = pstats.Stats(self.profilers[name])
+        rows = []
+        for (fileName, line, function), row in stats.stats.items():
+            _, calls, tottime, cumtime, _ = row
+            rows.append(
+                {
+                    "function": f"{fileName}:{line}({function})",
+                    "calls": calls,
+                    "tottime": tottime,
+                    "cumtime": cumtime,
+                }
+            )
+        rows.sort(key=lambda row: row["cumtime"], reverse=True)
+        return rows[:REPORT_TOP]
+
+    def report(self):
+        """Everything recorded so far as a JSON-serialisable dict"""
+        report = {
+            "phases": self.phases,
+            "counts": self.counts,
+            "peak_rss_bytes": peakRss(),
+        }
+        if self.memory:
+            report["memory"] = self.memory
+        if self.profilers:
+            report["profiles"] = {
+                name: self.profileReport(name) for name in self.profilers
+            }
+        return report
+
+    def save(self, path):
+        """Write report() to a JSON file"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class LatencyHistogram:
+    """Counts of latencies in exponentially growing buckets.
+
+    Recording is a bisect and an increment, so a long-running server can
+    keep one per endpoint. Percentiles are the upper bound of the bucket
+    they fall in, i.e. accurate to a factor of two.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last bucket: above every bound
+        self.total = 0
+        self.seconds = 0.0
+        self.maximum = 0.0
+
+    def record(self, seconds):
+        """Add one latency, in seconds"""
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.total += 1
+        self.seconds += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile, in seconds"""
+        if not self.total:
+            return 0.0
+        rank = percent / 100 * self.total
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.bounds[bucket] if bucket < len(self.bounds) else self.maximum
+        return self.maximum
+
+    def report(self):
+        """Count, mean, percentiles and non-empty buckets, in milliseconds"""
+        report = {
+            "count": self.total,
+            "mean_ms": self.seconds / self.total * 1000 if self.total else 0.0,
+            "max_ms": self.maximum * 1000,
+        }
+        for percent in (50, 90, 99):
+            report[f"p{percent}_ms"] = self.percentile(percent) * 1000
+        report["buckets_ms"] = {
+            (f"{self.bounds[bucket] * 1000:g}" if bucket < len(self.bounds) else "inf"): count
+            for bucket, count in enumerate(self.counts)
+            if count
+        }
+        return report
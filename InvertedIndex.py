@@ -0,0 +1,555 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+from scipy import sparse
+
+# Postings per compressed block; each block has a skip entry (see
+# compressPostings)
+POSTING_BLOCK_SIZE = 128
+
+# Counts are stored in one byte; this value marks a count kept in the
+# tfOverflow arrays instead
+TF_OVERFLOW = 255
+
+# postingsAt decodes only the blocks it needs while they are at most one in
+# SELECTIVE_DECODE_RATIO of the term's blocks, and otherwise reads the whole
+# (cached) postings list
+SELECTIVE_DECODE_RATIO = 4
+
+# Decoded postings lists kept by InvertedIndex.postings. Query terms are
+# Zipfian, so a small LRU cache saves most of the decoding.
+POSTINGS_CACHE_SIZE = 1024
+
+
+class InvertedIndex:
+    """Term -> postings of (doc_id, tf) kept in flat numpy arrays.
+
+    Term t has postings termOffsets[t] to termOffsets[t + 1], sorted by
+    document id and stored compressed in blocks termBlocks[t] to
+    termBlocks[t + 1]: document id gaps as varints in postingDocBytes, one
+    count byte per posting in postingTfBytes (see compressPostings).
+    postings(t) decodes one list, allPostings() all of them. The same counts are also kept document-major
+    in docOffsets/docTermIds/docTfs so a document vector can be read back
+    without scanning every postings list. Only the compressed postings are
+    saved: a loaded index rebuilds the document-major arrays from them the
+    first time a method needs them (ensureDocumentArrays), so searching a
+    loaded index only reads the memory-mapped postings.
+
+    The document-major arrays are the primary copy: addDocuments,
+    removeDocuments and replaceDocument splice them and keep the document
+    frequencies up to date, while the postings are rebuilt lazily the next
+    time they are needed. Removed documents keep their id and an empty row
+    and are flagged in liveDocuments.
+    """
+
+    # Document-major arrays, rebuilt from the postings after load()
+    DOCUMENT_ARRAYS = ("docOffsets", "docTermIds", "docTfs")
+
+    # Arrays written by save() and read back by load()
+    ARRAYS = (
+        "liveDocuments",
+        "termOffsets",
+        "termBlocks",
+        "blockLastDocIds",
+        "blockDocOffsets",
+        "postingDocBytes",
+        "postingTfBytes",
+        "tfOverflowPositions",
+        "tfOverflowValues",
+    )
+
+    def __init__(self, numTerms=0):
+        self.numTerms = numTerms
+        self.numDocuments = 0
+        self.docOffsets = np.zeros(1, dtype=np.int64)
+        self.docTermIds = np.empty(0, dtype=np.int32)
+        self.docTfs = np.empty(0, dtype=np.int32)
+        self.liveDocuments = np.empty(0, dtype=bool)
+        self.docFrequencies = np.zeros(numTerms, dtype=np.int64)
+        self.termOffsets = np.zeros(numTerms + 1, dtype=np.int64)
+        self.termBlocks = np.zeros(numTerms + 1, dtype=np.int32)
+        self.blockLastDocIds = np.empty(0, dtype=np.int32)
+        self.blockDocOffsets = np.zeros(1, dtype=np.int32)
+        self.postingDocBytes = np.empty(0, dtype=np.uint8)
+        self.postingTfBytes = np.empty(0, dtype=np.uint8)
+        self.tfOverflowPositions = np.empty(0, dtype=np.int64)
+        self.tfOverflowValues = np.empty(0, dtype=np.int32)
+        self.postingsStale = False
+        self.documentArraysStale = False  # Loaded: only the postings are read in
+        self.cachedPostings = lru_cache(maxsize=POSTINGS_CACHE_SIZE)(self.decodePostings)
+
+    @classmethod
+    def fromArrays(cls, lengths, termIds, tfs, numTerms):
+        """Build the index from flat document-major entries (see sortEntries)"""
+        index = cls(numTerms)
+        index.numDocuments = len(lengths)
+        index.docOffsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        index.docTermIds = termIds
+        index.docTfs = tfs
+        index.liveDocuments = np.ones(index.numDocuments, dtype=bool)
+        index.buildPostings()
+        index.docFrequencies = np.diff(index.termOffsets)
+        return index
+
+    def buildPostings(self):
+        """Derive the term-major postings from the document-major arrays"""
+        # A stable sort on term id keeps document ids ascending in each list
+        order = np.argsort(self.docTermIds, kind="stable")
+        counts = np.bincount(self.docTermIds, minlength=self.numTerms)
+        self.termOffsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        (
+            self.termBlocks,
+            self.blockLastDocIds,
+            self.blockDocOffsets,
+            self.postingDocBytes,
+            self.postingTfBytes,
+            self.tfOverflowPositions,
+            self.tfOverflowValues,
+        ) = compressPostings(
+            self.termOffsets, self.documentIdsOfEntries()[order], self.docTfs[order]
+        )
+        self.cachedPostings.cache_clear()
+        self.postingsStale = False
+
+    def ensurePostings(self):
+        """Rebuild the postings if documents changed since they were built"""
+        if self.postingsStale:
+            self.buildPostings()
+
+    def ensureDocumentArrays(self):
+        """Derive the document-major arrays from the postings if not done yet"""
+        if not self.documentArraysStale:
+            return
+        docIds, tfs = self.allPostings()
+        # A stable sort on document id keeps term ids ascending in each document
+        order = np.argsort(docIds, kind="stable")
+        lengths = np.bincount(docIds, minlength=self.numDocuments)
+        self.docOffsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        self.docTermIds = self.postingTermIds()[order]
+        self.docTfs = tfs[order].astype(np.int32)
+        self.documentArraysStale = False  # Last, so readers never see a mix
+
+    def documentIdsOfEntries(self):
+        """Document id of every entry in the document-major arrays"""
+        return np.repeat(
+            np.arange(self.numDocuments, dtype=np.int32), np.diff(self.docOffsets)
+        )
+
+    def addDocuments(self, termCounts, numTerms):
+        """Append documents given as {termId: tf} mappings and return their ids.
+
+        numTerms may grow to cover terms first seen in these documents.
+        """
+        self.ensureDocumentArrays()
+        lengths, termIds, tfs = countsToArrays(termCounts)
+        firstId = self.numDocuments
+        self.growTerms(numTerms)
+
+        self.docOffsets = np.concatenate(
+            (self.docOffsets, self.docOffsets[-1] + np.cumsum(lengths))
+        )
+        self.docTermIds = np.concatenate((self.docTermIds, termIds))
+        self.docTfs = np.concatenate((self.docTfs, tfs))
+        self.liveDocuments = np.concatenate(
+            (self.liveDocuments, np.ones(len(lengths), dtype=bool))
+        )
+        self.numDocuments += len(lengths)
+        self.docFrequencies += np.bincount(termIds, minlength=self.numTerms)
+        self.postingsStale = True
+        return range(firstId, self.numDocuments)
+
+    def removeDocuments(self, documentIds):
+        """Empty and flag the given documents; their ids are not reused"""
+        documentIds = np.unique(np.asarray(documentIds, dtype=np.int64))
+        outside = documentIds[(documentIds < 0) | (documentIds >= self.numDocuments)]
+        if len(outside):
+            raise ValueError(f"Document id {outside[0]} is out of range")
+        self.ensureDocumentArrays()
+        documentIds = documentIds[self.liveDocuments[documentIds]]
+        if len(documentIds) == 0:
+            return
+
+        removed = np.isin(self.documentIdsOfEntries(), documentIds)
+        self.docFrequencies -= np.bincount(
+            self.docTermIds[removed], minlength=self.numTerms
+        )
+        lengths = np.diff(self.docOffsets)
+        lengths[documentIds] = 0
+        self.docOffsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        self.docTermIds = self.docTermIds[~removed]
+        self.docTfs = self.docTfs[~removed]
+        self.liveDocuments = self.liveDocuments.copy()
+        self.liveDocuments[documentIds] = False
+        self.postingsStale = True
+
+    def replaceDocument(self, documentId, counts, numTerms):
+        """Replace the {termId: tf} counts of one document, keeping its id"""
+        self.ensureDocumentArrays()
+        lengths, termIds, tfs = countsToArrays([counts])
+        self.growTerms(numTerms)
+        start, end = self.docOffsets[documentId], self.docOffsets[documentId + 1]
+
+        if self.liveDocuments[documentId]:
+            self.docFrequencies -= np.bincount(
+                self.docTermIds[start:end], minlength=self.numTerms
+            )
+        self.docFrequencies += np.bincount(termIds, minlength=self.numTerms)
+
+        self.docTermIds = np.concatenate(
+            (self.docTermIds[:start], termIds, self.docTermIds[end:])
+        )
+        self.docTfs = np.concatenate((self.docTfs[:start], tfs, self.docTfs[end:]))
+        self.docOffsets = self.docOffsets.copy()
+        self.docOffsets[documentId + 1 :] += lengths[0] - (end - start)
+        self.liveDocuments = self.liveDocuments.copy()
+        self.liveDocuments[documentId] = True
+        self.postingsStale = True
+
+    def growTerms(self, numTerms):
+        """Make room for term ids below numTerms"""
+        if numTerms > self.numTerms:
+            self.docFrequencies = np.concatenate(
+                (self.docFrequencies, np.zeros(numTerms - self.numTerms, np.int64))
+            )
+            self.numTerms = numTerms
+            self.postingsStale = True
+
+    def postings(self, termId, fromDocId=0):
+        """Return the (docIds, tfs) arrays of a term (read-only).
+
+        With fromDocId, only postings of documents >= fromDocId are returned,
+        and the skip entries let blocks before the first such posting be
+        skipped without decoding them.
+        """
+        self.ensurePostings()
+        if fromDocId > 0:
+            return self.decodePostings(int(termId), fromDocId)
+        return self.cachedPostings(int(termId))
+
+    def decodePostings(self, termId, fromDocId=0):
+        """Decode the postings of a term, from the block holding fromDocId on"""
+        first, end = self.termBlocks[termId], self.termBlocks[termId + 1]
+        start = first
+        if fromDocId > 0:
+            start += np.searchsorted(self.blockLastDocIds[first:end], fromDocId)
+        if start == end:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        gaps = decodeVarints(
+            self.postingDocBytes[self.blockDocOffsets[start] : self.blockDocOffsets[end]]
+        )
+        if start > first:  # Gaps continue from the last document of the block before
+            gaps[0] += self.blockLastDocIds[start - 1]
+        docIds = np.cumsum(gaps)
+        tfs = self.decodeTfs(
+            self.termOffsets[termId] + (start - first) * POSTING_BLOCK_SIZE,
+            self.termOffsets[termId + 1],
+        )
+        if fromDocId > 0:
+            skip = np.searchsorted(docIds, fromDocId)
+            docIds, tfs = docIds[skip:], tfs[skip:]
+        docIds.flags.writeable = False
+        tfs.flags.writeable = False
+        return docIds, tfs
+
+    def postingsAt(self, termId, docIds):
+        """Counts of a term in the ascending documents docIds (0 where absent).
+
+        The skip entries pick the blocks that can hold the documents; if
+        they are a small part of the list, only those blocks are decoded.
+        """
+        self.ensurePostings()
+        docIds = np.asarray(docIds, dtype=np.int64)
+        first, end = self.termBlocks[termId], self.termBlocks[termId + 1]
+        tfs = np.zeros(len(docIds), dtype=np.int64)
+        blocks = first + np.searchsorted(self.blockLastDocIds[first:end], docIds)
+        blocks = np.unique(blocks[blocks < end])
+        if len(blocks) == 0:
+            return tfs
+        if len(blocks) * SELECTIVE_DECODE_RATIO > end - first:
+            # Most blocks are needed anyway: look them up in the (cached) list
+            termDocIds, termTfs = self.cachedPostings(int(termId))
+            positions = np.minimum(np.searchsorted(termDocIds, docIds), len(termDocIds) - 1)
+            found = termDocIds[positions] == docIds
+            tfs[found] = termTfs[positions[found]]
+            return tfs
+
+        # Byte ranges and posting ranges of the chosen blocks, concatenated
+        byteStarts = self.blockDocOffsets[blocks].astype(np.int64)
+        byteLengths = self.blockDocOffsets[blocks + 1] - byteStarts
+        gaps = decodeVarints(self.postingDocBytes[concatenatedRanges(byteStarts, byteLengths)])
+        postingStarts = self.termOffsets[termId] + (blocks - first) * POSTING_BLOCK_SIZE
+        postingLengths = (
+            np.minimum(postingStarts + POSTING_BLOCK_SIZE, self.termOffsets[termId + 1])
+            - postingStarts
+        )
+
+        # Gaps continue from the last document of the block before, and the
+        # running sum restarts at every block
+        blockStarts = np.cumsum(postingLengths) - postingLengths
+        gaps[blockStarts] += np.where(
+            blocks > first, self.blockLastDocIds[np.maximum(blocks - 1, 0)], 0
+        )
+        totals = np.cumsum(gaps)
+        blockDocIds = totals - np.repeat(totals[blockStarts] - gaps[blockStarts], postingLengths)
+
+        positions = np.searchsorted(blockDocIds, docIds)
+        found = positions < len(blockDocIds)
+        found[found] = blockDocIds[positions[found]] == docIds[found]
+        postings = concatenatedRanges(postingStarts, postingLengths)[positions[found]]
+        tfs[found] = self.tfsAt(postings)
+        return tfs
+
+    def tfsAt(self, positions):
+        """Counts of the postings at ascending positions, overflowed ones patched in"""
+        tfs = self.postingTfBytes[positions].astype(np.int64)
+        overflowed = np.flatnonzero(tfs == TF_OVERFLOW)
+        if len(overflowed):
+            tfs[overflowed] = self.tfOverflowValues[
+                np.searchsorted(self.tfOverflowPositions, positions[overflowed])
+            ]
+        return tfs
+
+    def decodeTfs(self, start, end):
+        """Counts of postings start to end, overflowed ones patched in"""
+        tfs = self.postingTfBytes[start:end].astype(np.int64)
+        if len(self.tfOverflowPositions):
+            low, high = np.searchsorted(self.tfOverflowPositions, (start, end))
+            tfs[self.tfOverflowPositions[low:high] - start] = self.tfOverflowValues[
+                low:high
+            ]
+        return tfs
+
+    def allPostings(self):
+        """(docIds, tfs) of every posting, term by term (see postingTermIds)"""
+        self.ensurePostings()
+        gaps = decodeVarints(self.postingDocBytes)
+        # Every term's first gap is its first document id, so undo the running
+        # sum of the terms before it
+        totals = np.concatenate(([0], np.cumsum(gaps)))
+        docIds = totals[1:] - np.repeat(
+            totals[self.termOffsets[:-1]], np.diff(self.termOffsets)
+        )
+        return docIds, self.decodeTfs(0, len(self.postingTfBytes))
+
+    def postingTermIds(self):
+        """Term id of every posting, aligned with allPostings()"""
+        self.ensurePostings()
+        return np.repeat(
+            np.arange(self.numTerms, dtype=np.int32), np.diff(self.termOffsets)
+        )
+
+    def termMaxima(self, postingWeights):
+        """Largest of postingWeights within each term's postings (0 if empty)"""
+        self.ensurePostings()
+        maxima = np.zeros(self.numTerms)
+        nonEmpty = np.flatnonzero(np.diff(self.termOffsets))
+        if len(nonEmpty):
+            maxima[nonEmpty] = np.maximum.reduceat(
+                postingWeights, self.termOffsets[nonEmpty]
+            )
+        return maxima
+
+    def documentTerms(self, documentId):
+        """Return the (termIds, tfs) arrays of a document"""
+        self.ensureDocumentArrays()
+        start, end = self.docOffsets[documentId], self.docOffsets[documentId + 1]
+        return self.docTermIds[start:end], self.docTfs[start:end]
+
+    def documentTermMatrix(self, documentIds, dtype=np.float64):
+        """Return the counts of some documents as a CSR document-term matrix"""
+        self.ensureDocumentArrays()
+        starts = self.docOffsets[documentIds]
+        lengths = self.docOffsets[documentIds + 1] - starts
+        entries = concatenatedRanges(starts, lengths)
+        return sparse.csr_matrix(
+            (
+                self.docTfs[entries].astype(dtype),
+                self.docTermIds[entries],
+                np.concatenate(([0], np.cumsum(lengths))),
+            ),
+            shape=(len(documentIds), self.numTerms),
+        )
+
+    def documentFrequencies(self):
+        """Number of documents containing each term"""
+        return self.docFrequencies
+
+    def numLiveDocuments(self):
+        """Number of documents that have not been removed"""
+        return int(np.count_nonzero(self.liveDocuments))
+
+    def documentLengths(self):
+        """Number of indexed tokens (sum of tf) in every document"""
+        if self.documentArraysStale:  # Count from the postings instead
+            docIds, tfs = self.allPostings()
+        else:
+            docIds, tfs = self.documentIdsOfEntries(), self.docTfs
+        return np.bincount(docIds, weights=tfs, minlength=self.numDocuments)
+
+    def documentNorms(self, termWeights=None):
+        """L2 norm of every document vector, tf optionally scaled per term"""
+        self.ensureDocumentArrays()
+        weights = self.docTfs.astype(np.float64)
+        if termWeights is not None:
+            weights *= termWeights[self.docTermIds]
+        return np.sqrt(
+            np.bincount(
+                self.documentIdsOfEntries(),
+                weights=weights**2,
+                minlength=self.numDocuments,
+            )
+        )
+
+    def nbytes(self):
+        """Memory held by the index arrays"""
+        return sum(
+            getattr(self, name).nbytes for name in self.DOCUMENT_ARRAYS + self.ARRAYS
+        )
+
+    def save(self, path):
+        """Write the postings and liveDocuments to <path>/<name>.npy"""
+        self.ensurePostings()
+        for name in self.ARRAYS:
+            saveArray(os.path.join(path, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, numDocuments, numTerms, mmap=True):
+        """Read an index written by save(), memory-mapping the saved arrays"""
+        index = cls(numTerms)
+        index.numDocuments = numDocuments
+        for name in cls.ARRAYS:
+            setattr(index, name, loadArray(os.path.join(path, f"{name}.npy"), mmap))
+        index.docFrequencies = np.diff(index.termOffsets)
+        index.documentArraysStale = True
+        return index
+
+
+def countsToArrays(termCounts):
+    """Flatten {termId: tf} mappings into (lengths, termIds, tfs) arrays.
+
+    Entries are document-major with term ids ascending inside each document.
+    """
+    numDocuments = len(termCounts)
+    lengths = np.fromiter(
+        (len(counts) for counts in termCounts), dtype=np.int64, count=numDocuments
+    )
+    total = int(lengths.sum())
+    termIds = np.fromiter(
+        (termId for counts in termCounts for termId in counts),
+        dtype=np.int32,
+        count=total,
+    )
+    tfs = np.fromiter(
+        (tf for counts in termCounts for tf in counts.values()),
+        dtype=np.int32,
+        count=total,
+    )
+    return sortEntries(lengths, termIds, tfs)
+
+
+def concatenatedRanges(starts, lengths):
+    """Indices of the ranges starts[i] to starts[i] + lengths[i], one after another"""
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(int(np.sum(lengths)))
+
+
+def encodeVarints(values):
+    """Variable-byte encode non-negative integers, 7 bits per byte.
+
+    The high bit of a byte is set when more bytes of the same value follow.
+    Returns (bytes, number of bytes of each value).
+    """
+    values = np.asarray(values, dtype=np.int64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28, 35):
+        lengths += values >= 1 << shift
+    owner = np.repeat(np.arange(len(values)), lengths)
+    position = np.arange(int(lengths.sum())) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    data = (values[owner] >> (7 * position)) & 0x7F
+    data |= (position < lengths[owner] - 1).astype(np.int64) << 7
+    return data.astype(np.uint8), lengths
+
+
+def decodeVarints(data):
+    """Decode the output of encodeVarints back into int64 values"""
+    data = np.asarray(data)
+    ends = np.flatnonzero(data < 0x80)
+    if len(ends) == len(data):  # Every value fits in one byte
+        return data.astype(np.int64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    position = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    payload = (data & 0x7F).astype(np.int64) << (7 * position)
+    return np.add.reduceat(payload, starts)
+
+
+def compressPostings(termOffsets, docIds, tfs, blockSize=POSTING_BLOCK_SIZE):
+    """Delta and varint encode term-major postings in blocks of blockSize.
+
+    Document ids are stored as gaps to the previous posting of the same term
+    (the first posting of a term as its id). Each block has a skip entry:
+    its last document id and where its bytes start, so a list can be decoded
+    from any block. Counts take one byte per posting; counts of TF_OVERFLOW
+    and more are listed by posting in the overflow arrays. Returns
+    (termBlocks, blockLastDocIds, blockDocOffsets, docBytes, tfBytes,
+    tfOverflowPositions, tfOverflowValues).
+    """
+    counts = np.diff(termOffsets)
+    blocksPerTerm = -(-counts // blockSize)
+    termBlocks = np.concatenate(([0], np.cumsum(blocksPerTerm)))
+    blockTerms = np.repeat(np.arange(len(counts)), blocksPerTerm)
+    blockStarts = termOffsets[blockTerms] + blockSize * (
+        np.arange(len(blockTerms)) - termBlocks[blockTerms]
+    )
+    blockEnds = np.minimum(blockStarts + blockSize, termOffsets[blockTerms + 1])
+
+    docIds = np.asarray(docIds, dtype=np.int64)
+    gaps = np.diff(docIds, prepend=0)
+    termStarts = termOffsets[:-1][counts > 0]
+    gaps[termStarts] = docIds[termStarts]
+    docBytes, docLengths = encodeVarints(gaps)
+    byteEnds = np.concatenate(([0], np.cumsum(docLengths)))
+    blockDocOffsets = np.concatenate(([0], byteEnds[blockEnds]))
+
+    tfs = np.asarray(tfs)
+    overflowPositions = np.flatnonzero(tfs >= TF_OVERFLOW)
+    return (
+        termBlocks.astype(offsetType(termBlocks[-1])),
+        docIds[blockEnds - 1].astype(np.int32),
+        blockDocOffsets.astype(offsetType(len(docBytes))),
+        docBytes,
+        np.minimum(tfs, TF_OVERFLOW).astype(np.uint8),
+        overflowPositions,
+        tfs[overflowPositions].astype(np.int32),
+    )
+
+
+def offsetType(largest):
+    """int32 for offsets up to largest if they fit, int64 otherwise"""
+    return np.int32 if largest < 2**31 else np.int64
+
+
+def sortEntries(lengths, termIds, tfs):
+    """Order flat entries document-major with term ids ascending per document.
+
+    lengths holds the number of entries of each document, in document order.
+    """
+    docIds = np.repeat(np.arange(len(lengths), dtype=np.int32), lengths)
+    order = np.lexsort((termIds, docIds))
+    return lengths, termIds[order], tfs[order]
+
+
+def saveArray(filePath, array):
+    """Save an array through a temporary file so live memory maps stay valid"""
+    tmpPath = filePath + ".tmp"
+    with open(tmpPath, "wb") as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(tmpPath, filePath)
+
+
+def loadArray(filePath, mmap=True):
+    """Load an array, read-only memory-mapped unless mmap is False"""
+    return np.load(filePath, mmap_mode="r" if mmap else None)
@@ -1,46 +1,204 @@
 # http://tartarus.org/~martin/PorterStemmer/python.txt
+import logging
+import os
 import re
-from nltk.tokenize import word_tokenize
+import threading
+from functools import lru_cache
 from PorterStemmer import PorterStemmer
-import jieba
+
+# nltk and jieba take over a second to import between them, so they are
+# imported on first use (see word_tokenize and jiebaModule)
+
+
+# Default number of distinct words whose stems are memoised per Parser
+STEM_CACHE_SIZE = 100_000
+
+WHITESPACE = re.compile(r"\s+")
+
+# Cleaned text that word_tokenize splits on whitespace and TREEBANK_SPLITS alone
+PLAIN_WORDS = re.compile(r"[a-z0-9]+(?: [a-z0-9]+)*")
+
+# Whole words the Treebank tokenizer behind word_tokenize splits in two
+TREEBANK_SPLITS = {
+    "cannot": ["can", "not"],
+    "gimme": ["gim", "me"],
+    "gonna": ["gon", "na"],
+    "gotta": ["got", "ta"],
+    "lemme": ["lem", "me"],
+    "wanna": ["wan", "na"],
+}
+
+# Segments without a letter, digit or CJK character (whitespace, punctuation)
+WORD_CHARACTER = re.compile(r"[^\W_]")
+
+# CJK ideograph runs, or runs of other letters and digits
+CJK = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+CJK_OR_WORD = re.compile(f"([{CJK}]+)|[^\\W_{CJK}]+")
+
+# Directory for jieba's cached prefix dictionary, instead of the temp dir
+JIEBA_CACHE_ENV = "JIEBA_CACHE_DIR"
+
+
+def word_tokenize(text):
+    """nltk's word_tokenize, importing nltk on the first call"""
+    from nltk.tokenize import word_tokenize
+
+    return word_tokenize(text)
+
+
+def jiebaModule():
+    """The jieba module, imported on the first call"""
+    import jieba
+
+    return jieba
+
+
+def warmUpJieba(quiet=False):
+    """Load jieba's prefix dictionary now rather than on the first cut.
+
+    jieba caches the dictionary it builds from dict.txt on disk, so after
+    the first run every process only unmarshals the cache. quiet drops
+    jieba's "Building prefix dict" log messages.
+    """
+    jieba = jiebaModule()
+    if quiet:
+        jieba.setLogLevel(logging.WARNING)
+    if jieba.dt.initialized:
+        return
+    cacheDir = os.environ.get(JIEBA_CACHE_ENV)
+    if cacheDir:
+        jieba.dt.tmp_dir = cacheDir
+    jieba.initialize()
+
+
+def loadStopwords(fileName):
+    """Whitespace-separated words of a stopword file shipped beside this module.
+
+    The path does not depend on the working directory; a missing file raises
+    FileNotFoundError instead of silently disabling stopword removal.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), fileName)
+    with open(path, "r", encoding="utf-8") as f:
+        return frozenset(f.read().split())
 
 
 class Parser:
-    """A processor for removing the commoner morphological and inflexional endings from words in English."""
+    """A processor for removing the commoner morphological and inflexional endings from words in English.
 
-    def __init__(self):
-        self.stemmer = PorterStemmer()
+    A Parser can be shared between threads: PorterStemmer keeps the word it
+    is stemming in instance attributes, so every thread gets its own.
+    """
+
+    def __init__(self, stemCacheSize=STEM_CACHE_SIZE):
+        self.threadState = threading.local()
+        # Word frequencies are Zipfian, so a bounded LRU cache in front of the
+        # pure-Python stemmer answers almost every lookup. None means unbounded.
+        self.stem = lru_cache(maxsize=stemCacheSize)(self._stem)
 
         # English stopwords from ftp://ftp.cs.cornell.edu/pub/smart/english.stop
-        try:
-            with open("english.stop", "r") as f:
-                self.stopwords = f.read().split()
-        except FileNotFoundError:
-            print("Error: 'english.stop' file not found.")
-            self.stopwords = []
+        self.stopwords = loadStopwords("english.stop")
+
+        # 中文停用詞（虛詞、代名詞、連接詞），一行一個
+        self.chineseStopwords = loadStopwords("chinese.stop")
 
     def clean(self, string):
         """Remove any unwanted characters from the string."""
         string = string.replace(".", "")
-        string = re.sub(r"\s+", " ", string)  # 使用正則表達式替換多個空格
+        string = WHITESPACE.sub(" ", string)  # 使用正則表達式替換多個空格
         string = string.lower()
         return string
 
+    @property
+    def stemmer(self):
+        """The calling thread's PorterStemmer."""
+        stemmer = getattr(self.threadState, "stemmer", None)
+        if stemmer is None:
+            stemmer = self.threadState.stemmer = PorterStemmer()
+        return stemmer
+
+    def _stem(self, word):
+        """Stem a single word with the Porter stemmer."""
+        return self.stemmer.stem(word, 0, len(word) - 1)
+
+    def stemCacheInfo(self):
+        """Hits, misses, maxsize and current size of the stem cache."""
+        return self.stem.cache_info()
+
     def removeStopWords(self, word_list):
         """Remove common words which have no search value."""
         return [word for word in word_list if word not in self.stopwords]
 
+    def words(self, string):
+        """Split cleaned text into words the way nltk's word_tokenize does.
+
+        Text of plain letters and digits (typical queries) is split on spaces
+        and TREEBANK_SPLITS, which gives the same words without importing nltk.
+        """
+        if PLAIN_WORDS.fullmatch(string):
+            words = string.split()
+            if TREEBANK_SPLITS.keys().isdisjoint(words):
+                return words
+            return [part for word in words for part in TREEBANK_SPLITS.get(word, [word])]
+        return word_tokenize(string)  # 使用 nltk 的 word_tokenize 進行分詞
+
     def tokenise(self, string):
         """Break string up into tokens and stem words."""
         string = self.clean(string)
-        words = word_tokenize(string)  # 使用 nltk 的 word_tokenize 進行分詞
-        return [
-            self.stemmer.stem(word, 0, len(word) - 1) for word in words
-        ]  # 進行詞幹提取
+        words = self.words(string)
+        return [self.stem(word) for word in words]  # 進行詞幹提取
+
+    def english_tokenise(self, string):
+        """Break string up into tokens, drop stopwords, then stem the rest.
+
+        Stopwords are filtered on the surface form, so they are never stemmed.
+        """
+        words = self.words(self.clean(string))
+        stopwords = self.stopwords
+        stem = self.stem
+        return [stem(word) for word in words if word not in stopwords]
 
     def chinese_tokenise(self, text):
-        return list(jieba.cut(text))  # 使用 jieba 進行中文分詞
+        """Segment text with jieba, dropping punctuation, whitespace and stopwords.
+
+        Latin words inside Chinese text are lowercased like English ones.
+        """
+        stopwords = self.chineseStopwords
+        return [
+            word
+            for word in jiebaModule().cut(text.lower())  # 使用 jieba 進行中文分詞
+            if WORD_CHARACTER.search(word) and word not in stopwords
+        ]
+
+    def chinese_bigrams(self, text):
+        """Split text into overlapping CJK character bigrams, without a dictionary.
+
+        A lone CJK character is kept as a unigram, and Latin words and numbers
+        stay whole. Unknown words such as 資安 are always found, at the cost
+        of some spurious bigrams across word boundaries.
+        """
+        stopwords = self.chineseStopwords
+        tokens = []
+        for match in CJK_OR_WORD.finditer(text.lower()):
+            run = match.group()
+            if match.group(1) is None or len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+        return [token for token in tokens if token not in stopwords]
 
+    def chinese_mixed_tokenise(self, text):
+        """jieba words followed by the CJK bigrams of the same text."""
+        stopwords = self.chineseStopwords
+        tokens = self.chinese_tokenise(text)
+        for match in CJK_OR_WORD.finditer(text):
+            run = match.group(1)
+            if run is not None:
+                tokens.extend(
+                    bigram
+                    for bigram in (run[i : i + 2] for i in range(len(run) - 1))
+                    if bigram not in stopwords
+                )
+        return tokens
 
 # 測試分詞功能
 # parser = Parser()  # Create an instance of the Parser class
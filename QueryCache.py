@@ -0,0 +1,116 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# Defaults of VectorSpace.queryCache
+CACHE_ENTRIES = 4096
+CACHE_BYTES = 16 * 2**20
+
+
+def estimateSize(value):
+    """Approximate memory held by a cache key or result, in bytes"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(estimateSize(item) for item in value)
+    return size
+
+
+class QueryCache:
+    """LRU cache of search results with an optional TTL and a memory budget.
+
+    Entries belong to one index version: the first get or put with a new
+    version drops everything cached for the old one, so results never
+    outlive a change to the index. Hit, miss and eviction counts are
+    available from stats(). All methods take a lock, so one cache can serve
+    several searching threads.
+    """
+
+    def __init__(
+        self, maxEntries=CACHE_ENTRIES, maxBytes=CACHE_BYTES, ttl=None, clock=time.monotonic
+    ):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttl = ttl  # Seconds an entry stays valid, None for no expiry
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()  # key -> (value, size, expiry), oldest first
+        self.version = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, version):
+        """Cached value of key for this index version, or None"""
+        with self.lock:
+            if version != self.version:
+                self.invalidate(version)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, _, expiry = entry
+            if expiry is not None and expiry <= self.clock():
+                self.discard(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, version):
+        """Cache value under key, evicting least recently used entries"""
+        with self.lock:
+            if version != self.version:
+                self.invalidate(version)
+            size = estimateSize(key) + estimateSize(value)
+            if self.maxEntries <= 0 or size > self.maxBytes:
+                return
+
+            self.discard(key)
+            expiry = None if self.ttl is None else self.clock() + self.ttl
+            self.entries[key] = (value, size, expiry)
+            self.bytes += size
+            while len(self.entries) > self.maxEntries or self.bytes > self.maxBytes:
+                _, (_, evictedSize, _) = self.entries.popitem(last=False)
+                self.bytes -= evictedSize
+                self.evictions += 1
+
+    def discard(self, key):
+        """Remove key if it is cached"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def invalidate(self, version=None):
+        """Drop every entry; later lookups belong to version"""
+        with self.lock:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.bytes = 0
+            self.version = version
+
+    def stats(self):
+        """Hit rate, counts and memory use of the cache"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
@@ -1,22 +1,38 @@
-import nltk
-from nltk.tokenize import word_tokenize
-from nltk import pos_tag
 import numpy as np
 
-# Check if the required resources are available
-try:
-    nltk.download("punkt", quiet=True)
-    nltk.download("averaged_perceptron_tagger", quiet=True)
-except Exception as e:
-    print(f"Error downloading NLTK resources: {e}")
-
-# Verify the NLTK data path
-# print("NLTK data paths:")
-# print(nltk.data.path)
+# Initial ranks searched for bottom-k (non-relevant) Rocchio documents
+FEEDBACK_WINDOW = 100
+
+# NLTK data used for POS tagging, looked up locally and never downloaded
+NLTK_RESOURCES = {
+    "punkt_tab": "tokenizers/punkt_tab/english/",
+    "averaged_perceptron_tagger_eng": "taggers/averaged_perceptron_tagger_eng/",
+}
+
+
+def check_nltk_resources():
+    """Raise LookupError naming any NLTK data that is not installed locally."""
+    import nltk
+
+    missing = []
+    for name, path in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            missing.append(name)
+    if missing:
+        raise LookupError(
+            f"Missing NLTK data: {', '.join(missing)}. "
+            f"Install it with: python -m nltk.downloader {' '.join(missing)}"
+        )
 
 
 def extract_nouns_verbs(text):
     """Extract nouns and verbs from the given text."""
+    from nltk import pos_tag
+    from nltk.tokenize import word_tokenize
+
+    check_nltk_resources()
     tokens = word_tokenize(text)
     tagged = pos_tag(tokens)
 
@@ -52,8 +68,93 @@ def create_new_query_vector(original_query, feedback_terms, vector_index):
     return new_query_vector
 
 
-def pseudo_feedback(vector_space, original_query, documents, file_paths):
-    """Perform pseudo feedback to re-rank documents based on the original query."""
+def rocchio_expansion(
+    vector_space,
+    original_query,
+    feedback_docs=5,
+    non_relevant_docs=0,
+    expansion_terms=10,
+    alpha=1.0,
+    beta=0.75,
+    gamma=0.15,
+):
+    """Rocchio-expanded TF-IDF query vector of a query, without printing.
+
+    The top feedback_docs documents of the initial ranking count as relevant
+    and, optionally, the last non_relevant_docs of its first FEEDBACK_WINDOW
+    as non-relevant. Only documents that match the query (score above 0)
+    are used; if none does, the query vector is returned unexpanded.
+    Returns (query_vector, expanded_vector).
+    """
+    query_vector = vector_space.makeQueryVector(original_query.split(), "tf-idf")
+    depth = FEEDBACK_WINDOW if non_relevant_docs else feedback_docs
+    initial = [
+        index
+        for index, score in vector_space.topDocuments(
+            query_vector, "cosine", "tf-idf", max(depth, feedback_docs)
+        )
+        if score > 0  # topDocuments pads with documents that do not match
+    ]
+    if not initial:
+        return query_vector, dict(query_vector)
+    relevant = initial[:feedback_docs]
+    non_relevant = initial[feedback_docs:][-non_relevant_docs:] if non_relevant_docs else []
+
+    expanded = vector_space.rocchio(
+        query_vector, relevant, non_relevant, alpha, beta, gamma, expansion_terms
+    )
+    return query_vector, expanded
+
+
+def rocchio_feedback(
+    vector_space,
+    original_query,
+    file_paths,
+    k=10,
+    feedback_docs=5,
+    non_relevant_docs=0,
+    expansion_terms=10,
+    alpha=1.0,
+    beta=0.75,
+    gamma=0.15,
+):
+    """Pseudo relevance feedback with Rocchio on the stored TF-IDF vectors.
+
+    The query is expanded by rocchio_expansion (see VectorSpace.rocchio)
+    and the expanded query is scored once more; nothing is tagged or
+    re-tokenised.
+    """
+    query_vector, expanded = rocchio_expansion(
+        vector_space,
+        original_query,
+        feedback_docs,
+        non_relevant_docs,
+        expansion_terms,
+        alpha,
+        beta,
+        gamma,
+    )
+    if not vector_space.quiet:
+        new_terms = [
+            vector_space.vectorKeywordIndex.term(term_id)
+            for term_id in sorted(expanded)
+            if term_id not in query_vector
+        ]
+        print(f"Expansion terms: {' '.join(new_terms)}")
+    re_ranked_results = vector_space.topDocuments(expanded, "cosine", "tf-idf", k)
+    vector_space.printResults(re_ranked_results, file_paths)
+    return re_ranked_results
+
+
+def pseudo_feedback(vector_space, original_query, documents, file_paths, mode="pos"):
+    """Perform pseudo feedback to re-rank documents based on the original query.
+
+    mode="pos" re-queries with the nouns and verbs of the top document;
+    mode="rocchio" uses rocchio_feedback instead and needs no NLTK data.
+    """
+    if mode == "rocchio":
+        return rocchio_feedback(vector_space, original_query, file_paths)
+
     # Step 1: Perform initial search
     initial_results = vector_space.search(
         original_query.split(),
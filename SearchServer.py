@@ -0,0 +1,403 @@
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from functools import partial
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from Instrumentation import LatencyHistogram
+from VectorSpace import RANKING_FUNCTIONS
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+
+# Searches arriving within BATCH_WINDOW seconds of the first one are scored
+# together, up to MAX_BATCH queries per matrix product. With 0, a batch holds
+# the searches parsed in one pass of the event loop: no added latency for a
+# lone client, batches as large as the concurrency under load.
+BATCH_WINDOW = 0.0
+MAX_BATCH = 64
+
+METHODS = ("cosine", "euclidean")
+WEIGHTINGS = ("tf", "tf-idf", *RANKING_FUNCTIONS)
+MAX_K = 1000
+
+# Largest request body read (and thrown away); endpoints take no body
+MAX_BODY = 64 * 1024
+
+
+class HttpError(Exception):
+    """A request the server answers with an error status"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parameter(params, name, default=None, cast=str):
+    """Query string parameter name converted by cast, or default if absent"""
+    values = params.get(name)
+    if not values:
+        if default is None:
+            raise HttpError(400, f"Missing parameter {name}")
+        return default
+    try:
+        return cast(values[0])
+    except ValueError:
+        raise HttpError(400, f"Invalid {name}: {values[0]}") from None
+
+
+def limit(params, name="k", default=10, low=1, high=MAX_K):
+    """An integer parameter (k by default), between low and high"""
+    value = parameter(params, name, default, int)
+    if not low <= value <= high:
+        raise HttpError(400, f"{name} must be between {low} and {high}")
+    return value
+
+
+async def readRequest(reader):
+    """(method, target, keepAlive) of the next request, or None at end of stream"""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HttpError(400, "Malformed request line") from None
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip().lower()
+    try:
+        length = int(headers.get("content-length", 0))
+        if length < 0:
+            raise ValueError
+    except ValueError:
+        raise HttpError(400, "Invalid Content-Length") from None
+    if length > MAX_BODY:
+        raise HttpError(413, f"Request bodies are limited to {MAX_BODY} bytes")
+    if length:
+        await reader.readexactly(length)  # Bodies are not used
+
+    connection = headers.get("connection", "")
+    if version == "HTTP/1.1":
+        keepAlive = connection != "close"
+    else:
+        keepAlive = connection == "keep-alive"
+    return method, target, keepAlive
+
+
+class MicroBatcher:
+    """Groups concurrent searches into one Searcher.search_batch call.
+
+    Searches with the same method, weighting and k that arrive within window
+    seconds of the first one (or until maxBatch of them are waiting) are
+    scored together on the executor. A lone query goes through
+    Searcher.search, which can use MaxScore.
+    """
+
+    def __init__(self, searcher, executor, window=BATCH_WINDOW, maxBatch=MAX_BATCH):
+        self.searcher = searcher
+        self.executor = executor
+        self.window = window
+        self.maxBatch = maxBatch
+        self.pending = {}  # (method, weighting, k) -> [(query, future), ...]
+        self.batchSizes = Counter()
+
+    async def search(self, query, method="cosine", weighting="tf-idf", k=10):
+        """Top-k (index, score) pairs of a query, scored in the next batch"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (method, weighting, k)
+        batch = self.pending.setdefault(key, [])
+        batch.append((query, future))
+        if len(batch) == 1:
+            loop.call_later(self.window, self.flush, key, batch)
+        if len(batch) >= self.maxBatch:
+            self.flush(key, batch)
+        return await future
+
+    def flush(self, key, batch):
+        """Send a waiting batch to the executor"""
+        if self.pending.get(key) is not batch:
+            return  # Already flushed when it filled up
+        del self.pending[key]
+        self.batchSizes[len(batch)] += 1
+        queries = [query for query, _ in batch]
+        futures = [future for _, future in batch]
+        scoring = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.score, key, queries
+        )
+        scoring.add_done_callback(partial(self.deliver, futures))
+
+    def score(self, key, queries):
+        """Results of a batch of queries; runs on the executor"""
+        method, weighting, k = key
+        if len(queries) == 1:
+            return [self.searcher.search(queries[0], method, weighting, k)]
+        return self.searcher.search_batch(queries, method, weighting, k)
+
+    @staticmethod
+    def deliver(futures, scoring):
+        """Hand every waiting request its result (or the batch's exception)"""
+        error = scoring.exception()
+        results = [None] * len(futures) if error else scoring.result()
+        for future, result in zip(futures, results):
+            if future.done():  # The client went away
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        """Number of batches, queries and the distribution of batch sizes"""
+        return {
+            "batches": sum(self.batchSizes.values()),
+            "queries": sum(size * count for size, count in self.batchSizes.items()),
+            "sizes": {str(size): count for size, count in sorted(self.batchSizes.items())},
+        }
+
+
+class SearchServer:
+    """HTTP/1.1 JSON search service over a Searcher, on asyncio streams.
+
+    GET /search?q=...&method=cosine&weighting=tf-idf&k=10
+    GET /related?id=...&k=10
+    GET /feedback?q=...&k=10&docs=5&terms=10   (Rocchio pseudo feedback)
+    GET /terms?prefix=...&k=10                  (indexed terms by prefix)
+    GET /stats                                  (latency histograms, batches, cache)
+
+    The event loop only parses requests and writes responses; scoring runs
+    on a thread pool, and concurrent searches are micro-batched (see
+    MicroBatcher). Every endpoint keeps a LatencyHistogram of the time
+    from a parsed request to its written response.
+    """
+
+    def __init__(
+        self,
+        searcher,
+        documentNames=None,
+        threads=None,
+        batchWindow=BATCH_WINDOW,
+        maxBatch=MAX_BATCH,
+    ):
+        self.searcher = searcher
+        self.documentNames = documentNames
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.threads, thread_name_prefix="search"
+        )
+        self.batcher = MicroBatcher(searcher, self.executor, batchWindow, maxBatch)
+        self.routes = {
+            "/search": self.search,
+            "/related": self.related,
+            "/feedback": self.feedback,
+            "/terms": self.terms,
+            "/stats": self.stats,
+        }
+        self.latencies = {}  # endpoint -> LatencyHistogram
+        self.started = time.monotonic()
+        self.server = None
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """Start listening; port 0 picks a free port (see address)"""
+        self.server = await asyncio.start_server(self.handleConnection, host, port)
+        return self.server
+
+    @property
+    def address(self):
+        """(host, port) the server listens on"""
+        return self.server.sockets[0].getsockname()[:2]
+
+    def close(self):
+        """Stop listening and shut the thread pool down"""
+        if self.server is not None:
+            self.server.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def handleConnection(self, reader, writer):
+        """Answer the requests of one connection until it closes"""
+        try:
+            while True:
+                try:
+                    request = await readRequest(reader)
+                except HttpError as e:
+                    await self.respond(writer, e.status, {"error": str(e)}, False)
+                    break
+                except ValueError:  # A line longer than the stream limit
+                    error = {"error": "Request line or header too long"}
+                    await self.respond(writer, 400, error, False)
+                    break
+                if request is None:
+                    break
+                method, target, keepAlive = request
+                start = time.perf_counter()
+                endpoint, status, payload = await self.dispatch(method, target)
+                await self.respond(writer, status, payload, keepAlive)
+                self.latency(endpoint).record(time.perf_counter() - start)
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # Client disconnected mid-request
+        except asyncio.CancelledError:
+            pass  # Server shutting down with the connection open
+        finally:
+            writer.close()
+            with suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def dispatch(self, method, target):
+        """(endpoint, status, JSON payload) of one request"""
+        url = urlsplit(target)
+        handler = self.routes.get(url.path)
+        endpoint = url.path if handler is not None else "other"
+        if handler is None:
+            return endpoint, 404, {"error": f"No endpoint {url.path}"}
+        if method != "GET":
+            return endpoint, 405, {"error": f"{method} is not supported"}
+        try:
+            return endpoint, 200, await handler(parse_qs(url.query))
+        except HttpError as e:
+            return endpoint, e.status, {"error": str(e)}
+        except IndexError as e:
+            return endpoint, 404, {"error": str(e)}
+        except ValueError as e:
+            return endpoint, 400, {"error": str(e)}
+        except Exception as e:
+            return endpoint, 500, {"error": f"{type(e).__name__}: {e}"}
+
+    @staticmethod
+    async def respond(writer, status, payload, keepAlive):
+        """Write a JSON response"""
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keepAlive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    def latency(self, endpoint):
+        """The LatencyHistogram of an endpoint"""
+        if endpoint not in self.latencies:
+            self.latencies[endpoint] = LatencyHistogram()
+        return self.latencies[endpoint]
+
+    def results(self, top_ratings):
+        """JSON list of (index, score) pairs, with document names if known"""
+        results = []
+        for index, score in top_ratings:
+            result = {"id": index, "score": score}
+            if self.documentNames is not None:
+                result["document"] = self.documentNames[index]
+            results.append(result)
+        return results
+
+    async def run(self, function, *args):
+        """Run a Searcher method on the thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+
+    async def search(self, params):
+        query = parameter(params, "q")
+        method = parameter(params, "method", "cosine")
+        weighting = parameter(params, "weighting", "tf-idf")
+        if method not in METHODS or weighting not in WEIGHTINGS:
+            raise HttpError(400, f"Unknown method {method} or weighting {weighting}")
+        self.searcher.vectorSpace.largerIsBetter(method, weighting)  # Rejects bad pairs
+        top_ratings = await self.batcher.search(query, method, weighting, limit(params))
+        return {"query": query, "results": self.results(top_ratings)}
+
+    async def related(self, params):
+        documentId = parameter(params, "id", cast=int)
+        if not 0 <= documentId < self.searcher.vectorSpace.index.numDocuments:
+            raise HttpError(404, f"Document id {documentId} is out of range")
+        top_ratings = await self.run(
+            self.searcher.related, documentId, "cosine", limit(params)
+        )
+        return {"id": documentId, "results": self.results(top_ratings)}
+
+    async def feedback(self, params):
+        query = parameter(params, "q")
+        top_ratings = await self.run(
+            partial(
+                self.searcher.feedback,
+                query,
+                limit(params),
+                feedbackDocs=limit(params, "docs", 5),
+                expansionTerms=limit(params, "terms", 10, low=0),
+            )
+        )
+        return {"query": query, "results": self.results(top_ratings)}
+
+    async def terms(self, params):
+        prefix = parameter(params, "prefix", "")
+        vectorSpace = self.searcher.vectorSpace
+        termIds = vectorSpace.vectorKeywordIndex.prefix(prefix)[: limit(params)]
+        documentFrequencies = vectorSpace.index.documentFrequencies()
+        return {
+            "prefix": prefix,
+            "terms": [
+                {
+                    "term": vectorSpace.vectorKeywordIndex.term(termId),
+                    "id": termId,
+                    "df": int(documentFrequencies[termId]),
+                }
+                for termId in termIds.tolist()
+            ],
+        }
+
+    async def stats(self, params):
+        vectorSpace = self.searcher.vectorSpace
+        cache = vectorSpace.queryCache
+        return {
+            "uptime_s": time.monotonic() - self.started,
+            "documents": int(vectorSpace.index.numLiveDocuments()),
+            "terms": len(vectorSpace.vectorKeywordIndex),
+            "threads": self.threads,
+            "latency": {
+                endpoint: histogram.report()
+                for endpoint, histogram in sorted(self.latencies.items())
+            },
+            "batches": self.batcher.stats(),
+            "cache": None if cache is None else cache.stats(),
+        }
+
+
+def serve(
+    searcher,
+    documentNames=None,
+    host=DEFAULT_HOST,
+    port=DEFAULT_PORT,
+    threads=None,
+    batchWindow=BATCH_WINDOW,
+    maxBatch=MAX_BATCH,
+):
+    """Run a SearchServer until interrupted"""
+    server = SearchServer(searcher, documentNames, threads, batchWindow, maxBatch)
+
+    async def run():
+        await server.start(host, port)
+        listenHost, listenPort = server.address
+        print(f"Serving on http://{listenHost}:{listenPort} (Ctrl+C to stop)")
+        async with server.server:
+            await server.server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,115 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from Relevance_feedback import rocchio_expansion
+
+# Weightings whose term weights and upper bounds are computed up front
+SEARCHER_WEIGHTINGS = ("tf", "tf-idf", "bm25")
+
+
+class Searcher:
+    """Read-only view of a built VectorSpace that threads can query at once.
+
+    Everything a query would otherwise compute lazily (IDF, norms, query
+    term weights, postings, MaxScore upper bounds) is computed here, so
+    searching only reads the index. Analysis uses the parser's per-thread
+    stemmer and the space's queryCache, which is locked. Nothing is printed and the
+    instrumentation of the space is left alone.
+
+    The index must not change while the Searcher is used: after
+    add_documents, remove_documents or update_document, make a new one.
+    """
+
+    def __init__(self, vectorSpace, weightings=SEARCHER_WEIGHTINGS):
+        self.vectorSpace = vectorSpace
+        vectorSpace.refresh()
+        vectorSpace.index.ensurePostings()
+        vectorSpace.warmUp()
+        for weighting in weightings:
+            vectorSpace.termWeights(weighting)
+            vectorSpace.termUpperBounds(weighting)
+        self.version = vectorSpace.version
+
+    def checkVersion(self):
+        """Raise if the documents of the vector space changed since construction"""
+        if self.vectorSpace.version != self.version:
+            raise RuntimeError("The index changed; create a new Searcher")
+
+    def cacheKey(self, searchList, method, weighting, k):
+        """(queryCache key, analysed terms) of a query, as VectorSpace.search uses"""
+        vectorSpace = self.vectorSpace
+        terms = vectorSpace.analyze(" ".join(searchList))
+        key = (tuple(sorted(terms)), method, vectorSpace.rankingKey(weighting), k)
+        return key, terms
+
+    def search(self, query, method="cosine", weighting="tf-idf", k=10):
+        """Top-k (index, score) pairs of a query string or term list"""
+        self.checkVersion()
+        vectorSpace = self.vectorSpace
+        searchList = query.split() if isinstance(query, str) else query
+        key, terms = self.cacheKey(searchList, method, weighting, k)
+        cache = vectorSpace.queryCache
+        cached = None if cache is None else cache.get(key, self.version)
+        if cached is not None:
+            return list(cached)
+
+        queryVector = vectorSpace.makeQueryVector(searchList, weighting, terms)
+        top_ratings = vectorSpace.topDocuments(queryVector, method, weighting, k)
+        if cache is not None:
+            cache.put(key, tuple(top_ratings), self.version)
+        return top_ratings
+
+    def search_batch(
+        self, queries, method="cosine", weighting="tf-idf", k=10, batch_size=256
+    ):
+        """Search many queries in sparse products (see VectorSpace.search_batch).
+
+        Cached queries are answered from queryCache; only the others are
+        scored, and their results are cached. Each query is analysed once,
+        for both its cache key and its query vector.
+        """
+        self.checkVersion()
+        queries = [query.split() if isinstance(query, str) else query for query in queries]
+        analysed = [self.cacheKey(query, method, weighting, k) for query in queries]
+        keys = [key for key, _ in analysed]
+        cache = self.vectorSpace.queryCache
+        results = [None if cache is None else cache.get(key, self.version) for key in keys]
+
+        misses = [position for position, result in enumerate(results) if result is None]
+        scored = self.vectorSpace.scoreBatch(
+            [queries[position] for position in misses],
+            method,
+            weighting,
+            k,
+            batch_size,
+            terms=[analysed[position][1] for position in misses],
+        )
+        for position, top_ratings in zip(misses, scored):
+            results[position] = top_ratings
+            if cache is not None:
+                cache.put(keys[position], tuple(top_ratings), self.version)
+        return [list(result) for result in results]
+
+    def related(self, documentId, method="cosine", k=10):
+        """Best k (index, score) pairs related to a document"""
+        self.checkVersion()
+        return self.vectorSpace.related(documentId, method, k)
+
+    def feedback(self, query, k=10, feedbackDocs=5, nonRelevantDocs=0, expansionTerms=10):
+        """Top-k (index, score) pairs after Rocchio pseudo relevance feedback"""
+        self.checkVersion()
+        _, expanded = rocchio_expansion(
+            self.vectorSpace, query, feedbackDocs, nonRelevantDocs, expansionTerms
+        )
+        return self.vectorSpace.topDocuments(expanded, "cosine", "tf-idf", k)
+
+    def search_parallel(
+        self, queries, method="cosine", weighting="tf-idf", k=10, workers=None
+    ):
+        """Search queries on a thread pool; results come back in query order"""
+        workers = workers or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(
+                executor.map(
+                    lambda query: self.search(query, method, weighting, k), queries
+                )
+            )
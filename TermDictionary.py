@@ -0,0 +1,224 @@
+import os
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+from InvertedIndex import loadArray, offsetType, saveArray
+
+# Terms added after the sorted arrays were built wait in a dict; it is
+# merged in once it holds this many terms (or a sixteenth of the vocabulary)
+COMPACT_MIN = 1024
+
+# Every INDEX_INTERVAL-th term is kept as a bytes object, so a lookup is a
+# bisect in C followed by a few probes into the arrays
+INDEX_INTERVAL = 16
+
+
+class TermDictionary:
+    """Sorted, array-backed map of terms to term ids.
+
+    Term i of the sorted vocabulary is the UTF-8 string
+    termBytes[termByteOffsets[i]:termByteOffsets[i + 1]] and has id
+    sortedTermIds[i], or simply i when sortedTermIds is empty, as it is for
+    a freshly built vocabulary. UTF-8 byte order is code point order, so this is the
+    order sorted() gives. Lookups bisect a sparse in-memory sample of the
+    terms and then the arrays, and prefix() and range() return the ids of a
+    run of the sorted order. The arrays can be memory-mapped, so loading a
+    saved index does not rebuild the vocabulary.
+
+    Terms added later (add) get the next free ids, which need not follow
+    the sorted order. They wait in a small dict until compact() merges them
+    into the arrays.
+    """
+
+    # Arrays written by save() and read back by load()
+    ARRAYS = ("termBytes", "termByteOffsets", "sortedTermIds")
+
+    def __init__(self, termBytes=None, termByteOffsets=None, sortedTermIds=None):
+        self.termBytes = np.empty(0, dtype=np.uint8) if termBytes is None else termBytes
+        self.termByteOffsets = (
+            np.zeros(1, dtype=np.int32) if termByteOffsets is None else termByteOffsets
+        )
+        self.sortedTermIds = (
+            np.empty(0, dtype=np.int32) if sortedTermIds is None else sortedTermIds
+        )
+        self.added = {}  # Terms added since the last compact(): term -> id
+        self.addedTerms = {}  # The same terms by id
+        self.attach()
+
+    @classmethod
+    def fromTerms(cls, terms, termIds=None):
+        """Dictionary of sorted, distinct terms; ids default to their rank"""
+        encoded = [term.encode("utf-8") for term in terms]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        termIds = np.asarray([] if termIds is None else termIds, dtype=np.int32)
+        if np.array_equal(termIds, np.arange(len(encoded))):
+            termIds = termIds[:0]  # Ids are ranks, no need to store them
+        return cls(
+            np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            offsets.astype(offsetType(offsets[-1])),
+            termIds,
+        )
+
+    def attach(self):
+        """Point the lookup views and the sparse term index at the arrays"""
+        # Indexing a memoryview gives plain ints, much faster than numpy
+        # scalars in the binary search loop
+        self.numSorted = len(self.termByteOffsets) - 1
+        self.byteView = memoryview(self.termBytes)
+        self.offsetView = memoryview(self.termByteOffsets)
+        self.idView = memoryview(self.sortedTermIds) if len(self.sortedTermIds) else None
+        self.positionView = None  # Sorted position of every id, made by term()
+        self.termIndex = [
+            self.termAt(position) for position in range(0, self.numSorted, INDEX_INTERVAL)
+        ]
+
+    def __len__(self):
+        return self.numSorted + len(self.added)
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __getitem__(self, term):
+        termId = self.get(term)
+        if termId is None:
+            raise KeyError(term)
+        return termId
+
+    def __iter__(self):
+        """Every term, in sorted order"""
+        self.compact()
+        return iter(self.terms())
+
+    def items(self):
+        """(term, termId) pairs in sorted term order"""
+        self.compact()
+        return zip(self.terms(), self.termIdsAt(0, self.numSorted).tolist())
+
+    def termAt(self, position):
+        """UTF-8 bytes of the term at a position of the sorted order"""
+        offsets = self.offsetView
+        return self.byteView[offsets[position] : offsets[position + 1]].tobytes()
+
+    def termIdsAt(self, start, end):
+        """Ids of the terms at positions start to end of the sorted order"""
+        if self.idView is None:
+            return np.arange(start, end, dtype=np.int32)
+        return self.sortedTermIds[start:end]
+
+    def terms(self, start=0, end=None):
+        """Decoded terms at positions start to end of the sorted order"""
+        end = self.numSorted if end is None else end
+        return [self.termAt(position).decode("utf-8") for position in range(start, end)]
+
+    def find(self, key, prefix=False):
+        """First sorted position whose term is not below the UTF-8 bytes key.
+
+        With prefix, the first position after every term starting with key.
+        """
+        # The answer lies after the last sampled term below key (or, with
+        # prefix, not above it once truncated) and at most INDEX_INTERVAL on
+        if prefix:
+            sample = bisect_right(self.termIndex, key, key=lambda term: term[: len(key)])
+        else:
+            sample = bisect_left(self.termIndex, key)
+        low = max(sample - 1, 0) * INDEX_INTERVAL
+        high = min(sample * INDEX_INTERVAL, self.numSorted)
+
+        byteView, offsetView = self.byteView, self.offsetView
+        while low < high:
+            middle = (low + high) // 2
+            term = byteView[offsetView[middle] : offsetView[middle + 1]].tobytes()
+            if (term[: len(key)] <= key) if prefix else (term < key):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, term, default=None):
+        """Id of term, or default if it is not in the dictionary"""
+        termId = self.added.get(term)
+        if termId is not None:
+            return termId
+        key = term.encode("utf-8")
+        position = self.find(key)
+        if position < self.numSorted and self.termAt(position) == key:
+            return position if self.idView is None else self.idView[position]
+        return default
+
+    def add(self, term):
+        """Id of term, giving it the next free id if it is new"""
+        termId = self.get(term)
+        if termId is None:
+            termId = self.added[term] = len(self)
+            self.addedTerms[termId] = term
+            if len(self.added) >= max(COMPACT_MIN, self.numSorted // 16):
+                self.compact()
+        return termId
+
+    def term(self, termId):
+        """The term with id termId"""
+        term = self.addedTerms.get(termId)
+        if term is not None:
+            return term
+        if not 0 <= termId < self.numSorted:
+            raise KeyError(termId)
+        if self.idView is None:
+            position = termId
+        else:
+            if self.positionView is None:
+                positions = np.empty(self.numSorted, dtype=np.int32)
+                positions[self.sortedTermIds] = np.arange(self.numSorted, dtype=np.int32)
+                self.positionView = memoryview(positions)
+            position = self.positionView[termId]
+        return self.termAt(position).decode("utf-8")
+
+    def range(self, low, high=None):
+        """Ids of the terms t with low <= t < high (no upper limit without high)"""
+        self.compact()
+        start = self.find(low.encode("utf-8"))
+        end = self.numSorted if high is None else self.find(high.encode("utf-8"))
+        return self.termIdsAt(start, max(start, end))
+
+    def prefix(self, prefix):
+        """Ids of the terms starting with prefix, in sorted term order"""
+        self.compact()
+        key = prefix.encode("utf-8")
+        return self.termIdsAt(self.find(key), self.find(key, prefix=True))
+
+    def compact(self):
+        """Merge the terms added since the last compact into the sorted arrays"""
+        if not self.added:
+            return
+        merged = sorted(
+            [
+                *zip(self.terms(), self.termIdsAt(0, self.numSorted).tolist()),
+                *self.added.items(),
+            ]
+        )
+        compacted = TermDictionary.fromTerms(
+            [term for term, _ in merged], [termId for _, termId in merged]
+        )
+        for name in self.ARRAYS:
+            setattr(self, name, getattr(compacted, name))
+        self.added = {}
+        self.addedTerms = {}
+        self.attach()
+
+    def nbytes(self):
+        """Memory held by the dictionary arrays (added terms not included)"""
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def save(self, path):
+        """Write the dictionary arrays to <path>/<name>.npy"""
+        self.compact()
+        for name in self.ARRAYS:
+            saveArray(os.path.join(path, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Read a dictionary written by save(), memory-mapping the arrays"""
+        return cls(
+            *(loadArray(os.path.join(path, f"{name}.npy"), mmap) for name in cls.ARRAYS)
+        )
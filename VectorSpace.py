@@ -1,185 +1,1035 @@
+import json
 import math
-from collections import defaultdict
+from collections import Counter
+from collections.abc import Sized
+from functools import partial
 import os
-from tqdm import tqdm
-from Parser import Parser
+import numpy as np
+from scipy import sparse
+from Parser import WORD_CHARACTER, Parser, warmUpJieba
+from InvertedIndex import InvertedIndex, loadArray, saveArray, sortEntries
+from Instrumentation import QUIET_ENV, Instrumentation, envFlag
+from QueryCache import QueryCache
+from TermDictionary import TermDictionary
 import util
 
+# On-disk index layout written by VectorSpace.save; bump when it changes
+INDEX_FORMAT = "vsm-index"
+INDEX_FORMAT_VERSION = 5
+
+# Weightings that are ranking functions rather than vector weights: their
+# scores are summed per term and higher is better, so only method="cosine"
+# (the similarity direction) applies to them.
+RANKING_FUNCTIONS = ("bm25", "bm25+", "pivoted")
+
+# k1 and b for BM25/BM25+, delta for BM25+, slope for pivoted normalisation
+DEFAULT_RANKING_PARAMETERS = {"k1": 1.2, "b": 0.75, "delta": 1.0, "slope": 0.2}
+
+# Relative rounding slack of MaxScore's comparisons against the k-th score
+MAX_SCORE_SLACK = 1e-9
+
+# Cost of MaxScore per query term and per posting and term, and of scoring
+# every document per posting, in units of one ranked document; fitted on 1k
+# to 79k document English indexes, where this picks the faster path within a
+# few percent
+MAX_SCORE_TERM_COST = 20000
+MAX_SCORE_POSTING_COST = 2
+EXHAUSTIVE_POSTING_COST = 8
+
+# Documents handed to one analyzeShard call during build
+SHARD_SIZE = 256
+
+# Analysers of the Chinese languages: jieba words, CJK character bigrams
+# (no dictionary, several times faster to build) or both
+CHINESE_ANALYZERS = {
+    "chinese": "chinese_tokenise",
+    "chinese-bigram": "chinese_bigrams",
+    "chinese-mixed": "chinese_mixed_tokenise",
+}
+
+# Per-process analysers used by analyzeShard, one per language
+_shardAnalyzers = {}
+
+
+def shardAnalyzer(language, quiet=None):
+    """The analyser of this worker process, created and warmed up once.
+
+    Also the process pool initializer, so dictionaries are loaded before
+    the first shard arrives.
+    """
+    if language not in _shardAnalyzers:
+        _shardAnalyzers[language] = VectorSpace(language=language, quiet=quiet)
+        _shardAnalyzers[language].warmUp()
+    return _shardAnalyzers[language]
+
+
+def analyzeShard(language, documents):
+    """Worker entry point of VectorSpace.build for workers > 1"""
+    return analyzeDocuments(shardAnalyzer(language).analyze, documents)
+
+
+def analyzeDocuments(analyze, documents):
+    """Tokenise one shard of documents and return its local term statistics.
+
+    Returns (vocabulary, lengths, termIds, tfs): the shard's distinct words
+    and its flat per-document counts, with term ids that index vocabulary.
+    """
+    vocabulary = {}
+    lengths, termIds, tfs = [], [], []
+    for document in documents:
+        counts = Counter(analyze(document))
+        lengths.append(len(counts))
+        termIds.extend(vocabulary.setdefault(word, len(vocabulary)) for word in counts)
+        tfs.extend(counts.values())
+
+    return (
+        list(vocabulary),
+        np.array(lengths, dtype=np.int64),
+        np.array(termIds, dtype=np.int32),
+        np.array(tfs, dtype=np.int32),
+    )
+
+
+def checkLimit(k):
+    """Reject a result count k below 1"""
+    if k < 1:
+        raise ValueError(f"k must be at least 1, not {k}")
+
 
 class VectorSpace:
-    """A simplified vector space model for document search using TF-IDF."""
+    """A simplified vector space model for document search using TF-IDF.
+
+    Documents are stored in an inverted index (see InvertedIndex) instead of
+    dense per-document vectors, and queries are scored from the postings of
+    their terms.
+    A built space can be written with save() and reopened with load(), and
+    grown or pruned with add_documents, remove_documents and update_document.
+
+    language is "english" or one of the CHINESE_ANALYZERS: "chinese" (jieba),
+    "chinese-bigram" or "chinese-mixed". Queries are analysed like documents.
+
+    weighting is "tf" or "tf-idf" for vector-space matching, or one of the
+    RANKING_FUNCTIONS ("bm25", "bm25+", "pivoted"), which are computed from
+    the stored document lengths and document frequencies and tuned through
+    rankingParameters.
 
-    def __init__(self, documents=[], language="english"):
-        self.documentTfVectors = []
-        self.documentIdfVectors = []
-        self.documentTfIdfVectors = []
-        self.vectorKeywordIndex = {}
+    Build phases, searches and their counts are recorded in instrumentation
+    (see Instrumentation). quiet (or VSM_QUIET=1) silences progress bars and
+    messages; search() still lists its results when given file_paths.
+
+    search() results are kept in queryCache (None disables it), keyed on the
+    analysed query terms and valid for one index version: version goes up
+    whenever documents are built, added, removed or updated.
+    """
+
+    def __init__(
+        self,
+        documents=[],
+        language="english",
+        workers=1,
+        quiet=None,
+        instrumentation=None,
+    ):
+        self.index = InvertedIndex()
+        self.documentIdfVectors = np.empty(0)
+        self.documentTfNorms = np.empty(0)
+        self.documentTfIdfNorms = np.empty(0)
+        self.vectorKeywordIndex = TermDictionary()
+        self.metadata = {}
+        self.stale = False  # IDF and norms lag behind the index
+        self.version = 0  # Bumped on every change to the indexed documents
+        self.queryCache = QueryCache()
+        self.pruning = True  # MaxScore top-k for cosine queries
+        self.documentLengths = np.empty(0)
+        self.averageDocumentLength = 1.0
+        self.rankingParameters = dict(DEFAULT_RANKING_PARAMETERS)
+        self.termWeightCache = {}  # weighting -> query-side term weights
+        self.termUpperBoundCache = {}  # weighting -> (rankingKey, upper bounds)
         self.language = language  # 新增language屬性
+        self.quiet = envFlag(QUIET_ENV) if quiet is None else quiet
+        self.instrumentation = instrumentation or Instrumentation()
         self.parser = Parser()
-        if len(documents) > 0:
-            self.build(documents)
-
-    def build(self, documents):
-        """Create the vector space for the passed document strings"""
-        self.vectorKeywordIndex = self.getVectorKeywordIndex(documents)
-        print(f"Vocabulary size: {len(self.vectorKeywordIndex)}")
-
-        print("Creating TF vectors...")
-        self.documentTfVectors = [
-            self.makeTfVector(document)
-            for document in tqdm(documents, desc="Processing documents")
-        ]
+        if not isinstance(documents, Sized) or len(documents) > 0:
+            self.build(documents, workers=workers)
 
-        print("Creating IDF vectors...")
-        self.documentIdfVectors = self.makeIdfVectors(documents)
+    def build(self, documents, workers=1):
+        """Create the vector space for the passed document strings.
 
-        print("Creating TF-IDF vectors...")
-        self.documentTfIdfVectors = self.makeTfIdfVectors()
+        documents may be any iterable, including a generator; it is consumed
+        in shards of SHARD_SIZE and each document is tokenised exactly once,
+        so raw text is only held one shard at a time. With workers > 1 (None
+        for one per CPU) shards are analysed in a process pool with a bounded
+        number in flight. Vocabulary, TF and DF are merged from the shard
+        results.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        from tqdm import tqdm
 
-    def getVectorKeywordIndex(self, documentList):
-        """Create the keyword to vector index mapping"""
-        vocabularyString = " ".join(documentList)
+        instrumentation = self.instrumentation
+        with instrumentation.profiled("build"), instrumentation.phase("build"):
+            shards = util.chunked(documents, SHARD_SIZE)
+            total = len(documents) if isinstance(documents, Sized) else None
 
-        # 根據language屬性選擇分詞方法
-        if self.language == "chinese":
-            vocabularyList = self.parser.chinese_tokenise(vocabularyString)
-        else:  # english
-            vocabularyList = self.parser.tokenise(vocabularyString)
-            vocabularyList = self.parser.removeStopWords(vocabularyList)
+            with instrumentation.phase("warm_up"):
+                self.warmUp()
+
+            self.log("Tokenising documents...")
+            progress = tqdm(total=total, desc="Processing documents", disable=self.quiet)
+            if workers == 1:
+                shardResults = (
+                    analyzeDocuments(self.analyze, shard) for shard in shards
+                )
+                self.mergeShards(shardResults, progress)
+            else:
+                workers = workers or os.cpu_count()
+                with ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=shardAnalyzer,
+                    initargs=(self.language, self.quiet),
+                ) as pool:
+                    shardResults = util.bounded_map(
+                        pool, partial(analyzeShard, self.language), shards, 2 * workers
+                    )
+                    self.mergeShards(shardResults, progress)
+            progress.close()
+            self.log(f"Vocabulary size: {len(self.vectorKeywordIndex)}")
 
-        uniqueVocabularyList = sorted(set(vocabularyList))
-        vectorIndex = {word: offset for offset, word in enumerate(uniqueVocabularyList)}
-        return vectorIndex
+            self.log("Creating IDF vectors...")
+            with instrumentation.phase("idf"):
+                self.documentIdfVectors = self.makeIdfVectors()
 
-    def makeTfVector(self, wordString):
-        """Create the TF vector for a document"""
-        vector = [0] * len(self.vectorKeywordIndex)
+            self.log("Creating TF-IDF vectors...")
+            with instrumentation.phase("tf_idf"):
+                self.makeDocumentNorms()
+
+        index = self.index
+        instrumentation.count("documents", index.numDocuments)
+        instrumentation.count("tokens", int(index.docTfs.sum()))
+        instrumentation.count("postings", len(index.docTermIds))
+        instrumentation.counts["terms"] = index.numTerms
+        self.version += 1
+
+    def log(self, message):
+        """Print a progress message unless the space is quiet"""
+        if not self.quiet:
+            print(message)
+
+    def mergeShards(self, shardResults, progress=None):
+        """Merge analyzeShard results, in document order, into the index.
+
+        Tokenising and the vocabulary merge are interleaved shard by shard,
+        so they are timed together as the "analyze" phase.
+        """
+        with self.instrumentation.phase("analyze"):
+            merged = self.mergeVocabularies(shardResults, progress)
+        with self.instrumentation.phase("tf"):
+            self.makeIndex(*merged)
 
-        # Language detection and tokenization
+    def mergeVocabularies(self, shardResults, progress=None):
+        """Map the shard-local term ids of analyzeShard results to global ids.
+
+        Returns (vocabulary, lengths, termIds, tfs) with provisional global
+        term ids in order of first occurrence, for makeIndex.
+        """
+        vocabulary = {}
+        lengths, termIds, tfs = [], [], []
+        for shardVocabulary, shardLengths, shardTermIds, shardTfs in shardResults:
+            localToGlobal = np.array(
+                [vocabulary.setdefault(word, len(vocabulary)) for word in shardVocabulary],
+                dtype=np.int32,
+            )
+            lengths.append(shardLengths)
+            termIds.append(localToGlobal[shardTermIds])
+            tfs.append(shardTfs)
+            if progress is not None:
+                progress.update(len(shardLengths))
+
+        return (
+            vocabulary,
+            np.concatenate(lengths or [np.empty(0, np.int64)]),
+            np.concatenate(termIds or [np.empty(0, np.int32)]),
+            np.concatenate(tfs or [np.empty(0, np.int32)]),
+        )
+
+    def makeIndex(self, vocabulary, lengths, termIds, tfs):
+        """Build the inverted index from mergeVocabularies output.
+
+        Term ids are renumbered once so that they follow the sorted vocabulary.
+        """
+        words = list(vocabulary)  # In provisional id order
+        order = sorted(range(len(words)), key=words.__getitem__)
+        renumber = np.empty(len(words), dtype=np.int32)
+        renumber[order] = np.arange(len(words), dtype=np.int32)
+        self.vectorKeywordIndex = self.getVectorKeywordIndex(
+            [words[termId] for termId in order]
+        )
+
+        self.log("Creating TF vectors...")
+        self.index = InvertedIndex.fromArrays(
+            *sortEntries(lengths, renumber[termIds], tfs),
+            len(self.vectorKeywordIndex),
+        )
+
+    def warmUp(self):
+        """Load the analyser's dictionaries ahead of the first document"""
+        if self.language in ("chinese", "chinese-mixed"):
+            warmUpJieba(self.quiet)
+
+    def analyze(self, text):
+        """Tokenise a string into the terms that are indexed"""
         # 根據language屬性選擇分詞方法
-        if self.language == "chinese":
-            wordList = self.parser.chinese_tokenise(wordString)
+        if self.language in CHINESE_ANALYZERS:
+            return getattr(self.parser, CHINESE_ANALYZERS[self.language])(text)
         else:  # english
-            wordList = self.parser.tokenise(wordString)
-            wordList = self.parser.removeStopWords(wordList)
+            return self.parser.english_tokenise(text)
 
-        for word in wordList:
-            if word in self.vectorKeywordIndex:
-                vector[self.vectorKeywordIndex[word]] += 1
+    def getVectorKeywordIndex(self, vocabulary):
+        """Create the keyword to vector index mapping from the distinct indexed words"""
+        return TermDictionary.fromTerms(sorted(vocabulary))
+
+    def makeTfVector(self, wordString):
+        """Create the sparse TF vector {termId: tf} for a document"""
+        return self.termTfVector(self.analyze(wordString))
+
+    def termTfVector(self, terms):
+        """Sparse TF vector {termId: tf} of already analysed terms"""
+        vector = Counter()
+        for word in terms:
+            termId = self.vectorKeywordIndex.get(word)
+            if termId is not None:
+                vector[termId] += 1
 
         return vector
 
-    def build_word_doc_count(self, documents):
-        """Count document frequency for each word"""
-        word_doc_count = defaultdict(int)
+    def makeIdfVectors(self):
+        """Create IDF vector for all terms from the indexed document frequencies"""
+        total_documents = self.index.numLiveDocuments()
+        docs_with_term = self.index.documentFrequencies()
+        return np.log(total_documents / (1 + docs_with_term)) + 1
+
+    def makeDocumentNorms(self):
+        """Precompute the TF and TF-IDF vector length of every document"""
+        self.documentTfNorms = self.index.documentNorms()
+        self.documentTfIdfNorms = self.index.documentNorms(self.documentIdfVectors)
+        self.measureDocumentLengths()
+        self.termWeightCache = {}
+        self.termUpperBoundCache = {}
+
+    def measureDocumentLengths(self):
+        """Token count of every document and its mean over the live documents"""
+        self.documentLengths = self.index.documentLengths()
+        live = self.index.liveDocuments
+        self.averageDocumentLength = (
+            self.documentLengths[live].mean() if live.any() else 1.0
+        )
+
+    def setRankingParameters(self, **params):
+        """Override some of the ranking parameters (k1, b, delta, slope)"""
+        unknown = sorted(set(params) - set(DEFAULT_RANKING_PARAMETERS))
+        if unknown:
+            raise ValueError(
+                f"Unknown ranking parameters {', '.join(unknown)}; "
+                f"expected some of {', '.join(DEFAULT_RANKING_PARAMETERS)}"
+            )
+        self.rankingParameters.update(params)
 
+    def rankingKey(self, weighting):
+        """Cache key of a weighting, including its parameters if it has any"""
+        if weighting in RANKING_FUNCTIONS:
+            return weighting, tuple(sorted(self.rankingParameters.items()))
+        return weighting
+
+    def largerIsBetter(self, method, weighting):
+        """Whether higher ratings rank first for this method and weighting"""
+        if weighting in RANKING_FUNCTIONS:
+            if method != "cosine":
+                raise ValueError(f"{weighting} is a ranking function; use method='cosine'")
+            return True
+        return method == "cosine"
+
+    def termWeights(self, weighting):
+        """Query-side weight of every term, or None for raw TF.
+
+        Computed once per index version, like the norms.
+        """
+        self.refresh()
+        if weighting == "tf-idf":
+            return self.documentIdfVectors
+        if weighting not in RANKING_FUNCTIONS:
+            return None  # Raw TF weighting
+        if weighting in self.termWeightCache:
+            return self.termWeightCache[weighting]
+
+        numDocuments = self.index.numLiveDocuments()
+        df = self.index.documentFrequencies()
+        if weighting in ("bm25", "bm25+"):
+            weights = np.log(1 + (numDocuments - df + 0.5) / (df + 0.5))
+        else:  # pivoted; terms of removed documents only can have df 0
+            ratios = np.ones(len(df))
+            np.divide(numDocuments + 1, df, out=ratios, where=df > 0)
+            weights = np.log(ratios)
+        self.termWeightCache[weighting] = weights
+        return weights
+
+    def documentTermWeights(self, tfs, lengths, weighting):
+        """Document-side term weights of the ranking functions.
+
+        BM25: tf (k1 + 1) / (tf + k1 (1 - b + b dl / avgdl)), plus delta for
+        BM25+; pivoted: (1 + ln(1 + ln tf)) / ((1 - s) + s dl / avgdl).
+        """
+        parameters = self.rankingParameters
+        relativeLengths = lengths / self.averageDocumentLength
+
+        if weighting == "pivoted":
+            slope = parameters["slope"]
+            return (1 + np.log1p(np.log(tfs))) / ((1 - slope) + slope * relativeLengths)
+
+        k1, b = parameters["k1"], parameters["b"]
+        weights = tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * relativeLengths))
+        if weighting == "bm25+":
+            weights = weights + parameters["delta"]
+        return weights
+
+    def documentWeights(self, termId, tfs, docIds, weighting="tf-idf"):
+        """Document-side weights of some postings of a term (or of each
+        posting's term), before tf and tf-idf length normalisation"""
+        if weighting in RANKING_FUNCTIONS:
+            return self.documentTermWeights(tfs, self.documentLengths[docIds], weighting)
+        if weighting == "tf-idf":
+            return tfs * self.documentIdfVectors[termId]
+        return tfs.astype(np.float64)  # Raw TF weighting
+
+    def normalizedPostingWeights(self, termIds, tfs, docIds, weighting="tf-idf"):
+        """Document-side weights of postings, normalised by document length.
+
+        For tf and tf-idf this is the weight in the unit-length document
+        vector; for the ranking functions it is their length-normalised tf
+        component.
+        """
+        if weighting in RANKING_FUNCTIONS:
+            return self.documentTermWeights(
+                tfs, self.documentLengths[docIds], weighting
+            )
+        documentNorms = self.documentNorms(weighting)
+        if weighting == "tf-idf":
+            return tfs * self.documentIdfVectors[termIds] / documentNorms[docIds]
+        else:  # Raw TF weighting
+            return tfs / documentNorms[docIds]
+
+    def termUpperBounds(self, weighting="tf-idf"):
+        """Largest normalised document weight of each term, for MaxScore"""
+        self.refresh()
+        key = self.rankingKey(weighting)
+        cached = self.termUpperBoundCache.get(weighting)
+        if cached is None or cached[0] != key:
+            # One entry per weighting: new ranking parameters replace the old
+            docIds, tfs = self.index.allPostings()
+            weights = self.normalizedPostingWeights(
+                self.index.postingTermIds(), tfs, docIds, weighting
+            )
+            cached = self.termUpperBoundCache[weighting] = (
+                key,
+                self.index.termMaxima(weights),
+            )
+        return cached[1]
+
+    def refresh(self):
+        """Recompute IDF and norms if documents changed since the last query"""
+        if not self.stale:
+            return
+        self.documentIdfVectors = self.makeIdfVectors()
+        self.makeDocumentNorms()
+        self.stale = False
+
+    def makeTermCounts(self, documents):
+        """Analyse documents into {termId: tf} mappings, adding unseen terms.
+
+        New terms get the next free ids, so existing ids never move.
+        """
+        termCounts = []
         for document in documents:
-            if self.language == "chinese":
-                wordList = self.parser.chinese_tokenise(document)
-            else:  # english
-                wordList = self.parser.tokenise(document)
-                wordList = self.parser.removeStopWords(wordList)
-            uniqueWords = set(wordList)
+            counts = {}
+            for word, tf in Counter(self.analyze(document)).items():
+                counts[self.vectorKeywordIndex.add(word)] = tf
+            termCounts.append(counts)
+        return termCounts
 
-            for word in uniqueWords:
-                word_doc_count[word] += 1
+    def add_documents(self, documents):
+        """Index more document strings and return the ids given to them.
 
-        return word_doc_count
+        Only the new documents are tokenised; IDF and norms are
+        recomputed lazily on the next query.
+        """
+        termCounts = self.makeTermCounts(documents)
+        documentIds = self.index.addDocuments(termCounts, len(self.vectorKeywordIndex))
+        self.stale = True
+        self.version += 1
+        return list(documentIds)
 
-    def makeIdfVectors(self, documents):
-        """Create IDF vector for all terms"""
-        word_doc_count = self.build_word_doc_count(documents)
-        total_documents = len(documents)
+    def remove_documents(self, documentIds):
+        """Remove documents from the index; they no longer appear in results.
 
-        idfVector = [0] * len(self.vectorKeywordIndex)
+        Raises ValueError, removing nothing, if an id is out of range.
+        """
+        self.index.removeDocuments(documentIds)
+        self.stale = True
+        self.version += 1
 
-        for term, index in tqdm(
-            self.vectorKeywordIndex.items(), desc="Calculating document IDF"
-        ):
-            docs_with_term = word_doc_count.get(term, 0)
-            idf = math.log(total_documents / (1 + docs_with_term)) + 1
-            idfVector[index] = idf
+    def update_document(self, documentId, document):
+        """Re-index the text of an existing document under the same id"""
+        if not 0 <= documentId < self.index.numDocuments:
+            raise IndexError(f"Document id {documentId} is out of range")
+        (counts,) = self.makeTermCounts([document])
+        self.index.replaceDocument(documentId, counts, len(self.vectorKeywordIndex))
+        self.stale = True
+        self.version += 1
 
-        return idfVector
+    def documentNorms(self, weighting="tf-idf"):
+        """Vector length of every document under tf or tf-idf weighting.
 
-    def makeTfIdfVectors(self):
-        """Create TF-IDF vectors by combining TF and IDF"""
-        tfIdfVectors = []
-        for tfVector in tqdm(
-            self.documentTfVectors, desc="Creating document TF-IDF vectors"
-        ):
-            tfIdfVector = [
-                tf * idf for tf, idf in zip(tfVector, self.documentIdfVectors)
-            ]
-            tfIdfVectors.append(tfIdfVector)
+        The ranking functions are not cosines and have no norms: their
+        document weights depend on rankingParameters and are computed from
+        the postings of the query terms (see postingScores).
+        """
+        self.refresh()
+        if weighting in RANKING_FUNCTIONS:
+            raise ValueError(f"{weighting} scores are not normalised by document norms")
+        if weighting == "tf-idf":
+            return self.documentTfIdfNorms
+        else:  # Raw TF weighting
+            return self.documentTfNorms
+
+    def postingsMatrix(self, termIds, weighting):
+        """Document-term matrix of the document weights of a weighting,
+        filled in for the given terms only (CSC, all documents and terms)"""
+        self.refresh()
+        termIds = np.unique(np.asarray(termIds, dtype=np.int64))
+        postings = [self.index.postings(termId) for termId in termIds]
+        counts = np.zeros(self.index.numTerms, dtype=np.int64)
+        counts[termIds] = [len(docIds) for docIds, _ in postings]
+        docIds = np.concatenate([docIds for docIds, _ in postings] or [np.empty(0, np.int64)])
+        tfs = np.concatenate([tfs for _, tfs in postings] or [np.empty(0, np.int64)])
+        postingTermIds = np.repeat(termIds, counts[termIds])
+        return sparse.csc_matrix(
+            (
+                self.documentWeights(postingTermIds, tfs, docIds, weighting),
+                docIds,
+                np.concatenate(([0], np.cumsum(counts))),
+            ),
+            shape=(self.index.numDocuments, self.index.numTerms),
+        )
+
+    def save(self, path, metadata=None):
+        """Write the vector space to the directory path.
+
+        Metadata goes to manifest.json; the term dictionary, IDF, norms and
+        the index arrays are stored as .npy files so load() can memory-map
+        them. The
+        manifest is written last, so a half-written index is never loaded.
+        """
+        self.refresh()
+        os.makedirs(path, exist_ok=True)
+        manifestPath = os.path.join(path, "manifest.json")
+        if os.path.exists(manifestPath):
+            os.remove(manifestPath)
+
+        self.index.save(path)
+        self.vectorKeywordIndex.save(path)
+        saveArray(os.path.join(path, "idf.npy"), self.documentIdfVectors)
+        saveArray(os.path.join(path, "tfNorms.npy"), self.documentTfNorms)
+        saveArray(os.path.join(path, "tfIdfNorms.npy"), self.documentTfIdfNorms)
+
+        manifest = {
+            "format": INDEX_FORMAT,
+            "version": INDEX_FORMAT_VERSION,
+            "language": self.language,
+            "numDocuments": int(self.index.numDocuments),
+            "numTerms": len(self.vectorKeywordIndex),
+            "metadata": metadata or {},
+        }
+        with open(manifestPath + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(manifestPath + ".tmp", manifestPath)
 
-        return tfIdfVectors
+    @staticmethod
+    def readManifest(path):
+        """Read and check the manifest of a saved index"""
+        with open(os.path.join(path, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format") != INDEX_FORMAT:
+            raise ValueError(f"{path} does not contain a vector space index")
+        if manifest.get("version") != INDEX_FORMAT_VERSION:
+            raise ValueError(
+                f"Index format version {manifest.get('version')} is not supported "
+                f"(expected {INDEX_FORMAT_VERSION})"
+            )
+        return manifest
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Open a vector space written by save().
+
+        The postings, IDF and norms are memory-mapped read-only, so several
+        processes share one copy through the page cache. Searches only read
+        the postings; the document-major arrays are rebuilt in memory from
+        them once something needs a document's terms (related, feedback,
+        changes). The saved metadata is available as the metadata attribute.
+        """
+        manifest = cls.readManifest(path)
+        vectorSpace = cls(language=manifest["language"])
+        vectorSpace.metadata = manifest["metadata"]
+        vectorSpace.vectorKeywordIndex = TermDictionary.load(path, mmap)
+        vectorSpace.index = InvertedIndex.load(
+            path, manifest["numDocuments"], manifest["numTerms"], mmap
+        )
+        vectorSpace.documentIdfVectors = loadArray(os.path.join(path, "idf.npy"), mmap)
+        vectorSpace.documentTfNorms = loadArray(os.path.join(path, "tfNorms.npy"), mmap)
+        vectorSpace.documentTfIdfNorms = loadArray(
+            os.path.join(path, "tfIdfNorms.npy"), mmap
+        )
+        vectorSpace.measureDocumentLengths()
+        return vectorSpace
 
     def buildQueryVector(self, termList):
-        """Convert query string into a vector"""
+        """Convert query string into a sparse TF-IDF vector {termId: weight}"""
+        self.refresh()
         queryTfVector = self.makeTfVector(" ".join(termList))
 
-        queryTfIdfVector = [
-            tf * idf for tf, idf in zip(queryTfVector, self.documentIdfVectors)
-        ]
+        return {
+            termId: tf * self.documentIdfVectors[termId]
+            for termId, tf in queryTfVector.items()
+        }
+
+    def rate(self, dots, documentNorms, queryNorms, method="cosine"):
+        """Turn dot products into cosine similarities or Euclidean distances.
+
+        dots is either one column of document scores or one column per query;
+        queryNorms broadcasts accordingly. Without documentNorms (ranking
+        functions) the dot products already are the scores. Removed documents
+        are rated -inf (cosine, ranking functions) or inf (euclidean) so they
+        always rank last.
+        """
+        removed = ~self.index.liveDocuments
+        if dots.ndim == 2:
+            removed = removed[:, np.newaxis]
+            if documentNorms is not None:
+                documentNorms = documentNorms[:, np.newaxis]
+        if documentNorms is None:
+            ratings = dots.astype(np.float64)
+            worst = -np.inf
+        elif method == "cosine":
+            denominators = documentNorms * queryNorms
+            ratings = np.zeros_like(dots)
+            np.divide(dots, denominators, out=ratings, where=denominators != 0)
+            worst = -np.inf
+        else:  # euclidean
+            squared = documentNorms**2 + queryNorms**2 - 2 * dots
+            ratings = np.sqrt(np.maximum(squared, 0))
+            worst = np.inf
+        if removed.any():
+            ratings = np.where(removed, worst, ratings)
+        return ratings
+
+    def queryArray(self, queryVector, numTerms):
+        """Dense array of a sparse query vector {termId: weight}"""
+        queryArray = np.zeros(numTerms)
+        queryArray[list(queryVector.keys())] = list(queryVector.values())
+        return queryArray
+
+    def scoreQueryVector(self, queryVector, method="cosine", weighting="tf-idf"):
+        """Rate every document against a sparse query vector {termId: weight}.
 
-        return queryTfIdfVector
+        The weighted postings of the query terms are added up for every
+        document (postingScores); tf and tf-idf dot products are then turned
+        into cosines or distances with the document norms.
+        """
+        dots = self.postingScores(queryVector, weighting)
+        if weighting in RANKING_FUNCTIONS:
+            return self.rate(dots, None, None, method)
+        queryArray = self.queryArray(queryVector, self.index.numTerms)
+        return self.rate(
+            dots, self.documentNorms(weighting), np.linalg.norm(queryArray), method
+        )
 
-    def euclidean_distance(self, vector1, vector2):
-        """Calculate the Euclidean distance between two vectors"""
-        if len(vector1) != len(vector2):
-            raise ValueError("Vectors must be of equal length")
+    def postingScores(self, queryVector, weighting):
+        """Dot product (or ranking function score) of every document with a
+        query vector, from the postings of the query terms"""
+        self.refresh()
+        scores = np.zeros(self.index.numDocuments)
+        for termId in sorted(queryVector):  # The order rescore sums in
+            docIds, tfs = self.index.postings(termId)
+            scores[docIds] += (
+                self.documentWeights(termId, tfs, docIds, weighting) * queryVector[termId]
+            )
+        return scores
 
-        return math.sqrt(sum((a - b) ** 2 for a, b in zip(vector1, vector2)))
+    def maxScoreTopK(self, queryVector, weighting="tf-idf", k=10):
+        """Top-k cosine (or ranking function) matches using MaxScore.
 
-    def related(self, documentId, method="cosine"):
-        """Find related documents to the given document ID"""
-        ratings = []
+        Query terms are taken one at a time, highest upper bound first, and
+        their postings add candidate documents until the bounds of the terms
+        left sum to less than the k-th best partial score. From then on no
+        other document can make the top k: candidates that cannot reach it
+        are dropped, and the remaining (frequent) terms are only looked up
+        for the others, decoding just the postings blocks that hold them.
+        Results equal the exhaustive ranking.
+        """
+        upperBounds = self.termUpperBounds(weighting)
+        if weighting in RANKING_FUNCTIONS:
+            queryNorm = 1.0  # Scores are plain sums, not cosines
+        else:
+            queryNorm = math.sqrt(sum(weight**2 for weight in queryVector.values()))
 
-        for documentVector in self.documentTfIdfVectors:
-            if method == "cosine":
-                rating = util.cosine(
-                    self.documentTfIdfVectors[documentId], documentVector
+        terms = sorted(
+            (
+                (weight / queryNorm * upperBounds[termId], termId, weight / queryNorm)
+                for termId, weight in queryVector.items()
+                if weight > 0
+            ),
+            reverse=True,
+        )
+        remaining = sum(bound for bound, _, _ in terms)
+        docIds, scores = np.empty(0, dtype=np.int64), np.empty(0)
+        threshold = -np.inf
+        for bound, termId, scale in terms:
+            # Slack for rounding, so a document tying the k-th score is kept
+            if remaining + MAX_SCORE_SLACK * abs(threshold) >= threshold:
+                termDocIds, tfs = self.index.postings(termId)
+                weights = scale * self.normalizedPostingWeights(
+                    termId, tfs, termDocIds, weighting
                 )
-            else:  # euclidean
-                rating = self.euclidean_distance(
-                    self.documentTfIdfVectors[documentId], documentVector
+                if len(docIds) == 0:
+                    docIds, scores = termDocIds, weights
+                else:
+                    docIds, inverse = np.unique(
+                        np.concatenate((docIds, termDocIds)), return_inverse=True
+                    )
+                    scores = np.bincount(
+                        inverse, np.concatenate((scores, weights)), len(docIds)
+                    )
+            else:
+                keep = scores + remaining + MAX_SCORE_SLACK * threshold >= threshold
+                docIds, scores = docIds[keep], scores[keep]
+                tfs = self.index.postingsAt(termId, docIds)
+                hits = np.flatnonzero(tfs)
+                scores[hits] += scale * self.normalizedPostingWeights(
+                    termId, tfs[hits], docIds[hits], weighting
                 )
-            ratings.append(rating)
+            remaining -= bound
+            if len(scores) >= k:
+                threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
 
-        return ratings
+        if len(scores) > k:
+            kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+            near = scores >= kth - MAX_SCORE_SLACK * kth
+            docIds, scores = docIds[near], scores[near]
 
-    def search(self, searchList, method="cosine", weighting="tf-idf", file_paths=[]):
-        """Search for documents that match based on a list of terms"""
-        if weighting == "tf-idf":
-            queryVector = self.buildQueryVector(searchList)
-            documentVectors = self.documentTfIdfVectors
-        else:  # Raw TF weighting
-            queryVector = self.makeTfVector(" ".join(searchList))
-            documentVectors = self.documentTfVectors
-
-        if method == "cosine":
-            print(f"Calculating Cosine similarity with {weighting} weighting...")
-            ratings = [
-                util.cosine(queryVector, documentVector)
-                for documentVector in tqdm(documentVectors, desc="Processing documents")
-            ]
-        else:  # Euclidean distance
-            print(f"Calculating Euclidean distance with {weighting} weighting...")
-            ratings = [
-                self.euclidean_distance(queryVector, documentVector)
-                for documentVector in tqdm(documentVectors, desc="Processing documents")
+        # Scores summed term by term can differ from the CSR product in the
+        # last bits. If two candidates are that close, rescore them the way
+        # scoreQueryVector does, so ties are ordered as in the exhaustive
+        # ranking.
+        ordered = np.sort(scores)
+        if np.any(np.diff(ordered) <= MAX_SCORE_SLACK * ordered[1:]):
+            scores = self.rescore(docIds, queryVector, weighting)
+
+        # Candidates are in id order, so ties keep ascending ids as in top_k
+        top = [(int(docIds[i]), float(scores[i])) for i in util.top_k(scores, k)]
+
+        # Like the exhaustive ranking, pad with non-matching documents in id order
+        if len(top) < k:
+            found = set(docIds.tolist())
+            for documentId in np.flatnonzero(self.index.liveDocuments):
+                if len(top) == k:
+                    break
+                if documentId not in found:
+                    top.append((int(documentId), 0.0))
+        return top
+
+    def rescore(self, docIds, queryVector, weighting="tf-idf"):
+        """Ratings of some documents, bit for bit as scoreQueryVector gives them.
+
+        Both sum each document's products term by term in ascending term id
+        order.
+        """
+        dots = np.zeros(len(docIds))
+        for termId in sorted(queryVector):
+            tfs = self.index.postingsAt(termId, docIds)
+            hits = np.flatnonzero(tfs)
+            dots[hits] += (
+                self.documentWeights(termId, tfs[hits], docIds[hits], weighting)
+                * queryVector[termId]
+            )
+        if weighting in RANKING_FUNCTIONS:
+            return dots
+        documentNorms = self.documentNorms(weighting)
+        queryArray = self.queryArray(queryVector, self.index.numTerms)
+        return dots / (documentNorms[docIds] * np.linalg.norm(queryArray))
+
+    def topDocuments(self, queryVector, method="cosine", weighting="tf-idf", k=10):
+        """Best k (index, score) pairs for a sparse query vector.
+
+        Cosine queries with non-negative weights use MaxScore when it is
+        expected to be cheaper than scoring every document (maxScorePays).
+        """
+        checkLimit(k)
+        largest = self.largerIsBetter(method, weighting)
+        if (
+            method == "cosine"
+            and self.pruning
+            and all(weight >= 0 for weight in queryVector.values())
+            and self.maxScorePays(queryVector, weighting)
+        ):
+            return self.maxScoreTopK(queryVector, weighting, k)
+
+        ratings = self.scoreQueryVector(queryVector, method, weighting)
+        top = util.top_k(ratings, k, largest=largest)
+        return [(int(index), float(ratings[index])) for index in top]
+
+    def maxScorePays(self, queryVector, weighting="tf-idf"):
+        """Whether MaxScore is expected to beat scoring every document.
+
+        Scoring every document adds up the query's postings, at
+        EXHAUSTIVE_POSTING_COST each, and then ranks every document (see
+        postingScores). MaxScore costs about MAX_SCORE_TERM_COST plus
+        MAX_SCORE_POSTING_COST per posting of the query for every query term
+        (see benchmark.py pruning).
+        """
+        documentFrequencies = self.index.documentFrequencies()
+        postings = sum(int(documentFrequencies[termId]) for termId in queryVector)
+        cost = len(queryVector) * (MAX_SCORE_TERM_COST + MAX_SCORE_POSTING_COST * postings)
+        return cost <= self.index.numDocuments + EXHAUSTIVE_POSTING_COST * postings
+
+    def related(self, documentId, method="cosine", k=None):
+        """Find related documents to the given document ID.
+
+        Returns the rating of every document, or with k only the best k
+        (index, score) pairs.
+        """
+        termIds, tfs = self.index.documentTerms(documentId)
+        self.refresh()
+        queryVector = dict(
+            zip(termIds.tolist(), (tfs * self.documentIdfVectors[termIds]).tolist())
+        )
+        if k is not None:
+            return self.topDocuments(queryVector, method, "tf-idf", k)
+
+        documentNorms = self.documentNorms("tf-idf")
+        dots = self.postingScores(queryVector, "tf-idf")
+        ratings = self.rate(dots, documentNorms, documentNorms[documentId], method)
+        return ratings.tolist()
+
+    def centroid(self, documentIds):
+        """Mean of the unit-length TF-IDF vectors of some documents (dense)"""
+        centroid = np.zeros(len(self.vectorKeywordIndex))
+        if len(documentIds) == 0:
+            return centroid
+        documentIds = np.asarray(documentIds)
+        norms = self.documentNorms("tf-idf")[documentIds]
+        scales = np.divide(1.0, norms, out=np.zeros(len(norms)), where=norms != 0)
+        rows = self.index.documentTermMatrix(documentIds)
+        rows.data *= self.documentIdfVectors[rows.indices]
+        rows = sparse.diags(scales) @ rows
+        centroid[:] = np.asarray(rows.sum(axis=0)).ravel() / len(documentIds)
+        return centroid
+
+    def rocchio(
+        self,
+        queryVector,
+        relevantIds,
+        nonRelevantIds=(),
+        alpha=1.0,
+        beta=0.75,
+        gamma=0.15,
+        expansionTerms=10,
+    ):
+        """Expand a TF-IDF query vector by Rocchio relevance feedback.
+
+        q' = alpha q + beta mean(relevant) - gamma mean(non-relevant), on
+        unit-length vectors. The original terms are kept, only the
+        expansionTerms best new words are added (punctuation tokens are
+        skipped), and terms whose weight ends up negative are dropped.
+        Returns the new {termId: weight} vector.
+        """
+        queryIds = np.fromiter(queryVector.keys(), dtype=np.int64, count=len(queryVector))
+        queryWeights = np.fromiter(
+            queryVector.values(), dtype=np.float64, count=len(queryVector)
+        )
+        queryNorm = np.linalg.norm(queryWeights)
+        if queryNorm:
+            queryWeights = queryWeights / queryNorm
+
+        feedback = beta * self.centroid(relevantIds) - gamma * self.centroid(
+            nonRelevantIds
+        )
+        weights = alpha * queryWeights + feedback[queryIds]
+        expanded = {
+            int(termId): float(weight)
+            for termId, weight in zip(queryIds, weights)
+            if weight > 0
+        }
+
+        feedback[queryIds] = 0  # Only rank terms the query does not have yet
+        for termId in self.expansionCandidates(feedback, expansionTerms):
+            expanded[termId] = float(feedback[termId])
+        return expanded
+
+    def expansionCandidates(self, feedback, count):
+        """Ids of the count best positive feedback terms that are words.
+
+        Terms without a letter, digit or CJK character (punctuation the
+        tokenizer kept) are skipped, fetching more candidates until count
+        words are found or the positive terms run out.
+        """
+        positive = int(np.count_nonzero(feedback > 0))
+        fetch = min(count, positive)
+        while fetch:
+            words = [
+                int(termId)
+                for termId in util.top_k(feedback, fetch)
+                if WORD_CHARACTER.search(self.vectorKeywordIndex.term(int(termId)))
             ]
+            if len(words) >= count or fetch == positive:
+                return words[:count]
+            fetch = min(2 * fetch, positive)
+        return []
 
-        print("\nNewsID Score")
-        indexed_ratings = list(enumerate(ratings))
-        top_ratings = sorted(
-            indexed_ratings, key=lambda x: x[1], reverse=(method == "cosine")
-        )[:10]
+    def makeQueryVector(self, searchList, weighting="tf-idf", terms=None):
+        """Build the sparse query vector for a list of terms and a weighting.
+
+        terms may hold the already analysed searchList. For the ranking
+        functions each query term is weighted by its query frequency times
+        the function's idf.
+        """
+        if terms is None:
+            terms = self.analyze(" ".join(searchList))
+        queryTfVector = self.termTfVector(terms)
+        if weighting == "tf-idf" or weighting in RANKING_FUNCTIONS:
+            termWeights = self.termWeights(weighting)
+            return {
+                termId: tf * termWeights[termId]
+                for termId, tf in queryTfVector.items()
+            }
+        else:  # Raw TF weighting
+            return queryTfVector
+
+    def makeQueryMatrix(self, queries, weighting="tf-idf", terms=None):
+        """Stack the query vectors of several term lists into a CSR matrix.
+
+        terms may hold the already analysed term list of every query.
+        """
+        rows, columns, values = [], [], []
+        for row, searchList in enumerate(queries):
+            queryVector = self.makeQueryVector(
+                searchList, weighting, None if terms is None else terms[row]
+            )
+            rows.extend([row] * len(queryVector))
+            columns.extend(queryVector.keys())
+            values.extend(queryVector.values())
+
+        return sparse.csr_matrix(
+            (values, (rows, columns)),
+            shape=(len(queries), len(self.vectorKeywordIndex)),
+            dtype=np.float64,
+        )
+
+    def search_batch(
+        self, queries, method="cosine", weighting="tf-idf", k=10, batch_size=256
+    ):
+        """Search many queries at once.
+
+        Each batch of queries becomes one query matrix that is scored in a
+        single sparse-sparse product against the document weights of the
+        batch's terms (postingsMatrix). Queries may be
+        term lists or plain strings. Returns the top-k [(index, score), ...]
+        of every query, in query order, without printing anything.
+        """
+        instrumentation = self.instrumentation
+        with instrumentation.profiled("search_batch"), instrumentation.phase(
+            "search_batch"
+        ):
+            results = self.scoreBatch(queries, method, weighting, k, batch_size)
 
+        instrumentation.count("batch_queries", len(queries))
+        return results
+
+    def scoreBatch(
+        self, queries, method="cosine", weighting="tf-idf", k=10, batch_size=256, terms=None
+    ):
+        """search_batch without instrumentation; only reads the index once refreshed.
+
+        terms may hold the already analysed term list of every query.
+        """
+        checkLimit(k)
+        queries = [
+            query.split() if isinstance(query, str) else query for query in queries
+        ]
+        largest = self.largerIsBetter(method, weighting)
+        documentNorms = (
+            None if weighting in RANKING_FUNCTIONS else self.documentNorms(weighting)
+        )
+        results = []
+
+        for start in range(0, len(queries), batch_size):
+            queryMatrix = self.makeQueryMatrix(
+                queries[start : start + batch_size],
+                weighting,
+                None if terms is None else terms[start : start + batch_size],
+            )
+            # Only the batch's terms get document weights
+            matrix = self.postingsMatrix(queryMatrix.indices, weighting)
+            dots = (matrix @ queryMatrix.T).toarray()
+            queryNorms = np.sqrt(queryMatrix.multiply(queryMatrix).sum(axis=1)).A1
+            ratings = self.rate(dots, documentNorms, queryNorms, method)
+
+            for column in range(ratings.shape[1]):
+                columnRatings = ratings[:, column]
+                top = util.top_k(columnRatings, k, largest=largest)
+                results.append(
+                    [(int(index), float(columnRatings[index])) for index in top]
+                )
+        return results
+
+    def search(
+        self, searchList, method="cosine", weighting="tf-idf", file_paths=[], k=10
+    ):
+        """Search for documents that match based on a list of terms.
+
+        Repeated queries (same analysed terms in any order, method, weighting
+        and k) are answered from queryCache until the index changes.
+        """
+        instrumentation = self.instrumentation
+        with instrumentation.profiled("search"), instrumentation.phase("search"):
+            terms = self.analyze(" ".join(searchList))
+            key = (tuple(sorted(terms)), method, self.rankingKey(weighting), k)
+            cache = self.queryCache
+            cached = None if cache is None else cache.get(key, self.version)
+
+            if cached is not None:
+                instrumentation.count("cache_hits")
+                top_ratings = list(cached)
+            else:
+                queryVector = self.makeQueryVector(searchList, weighting, terms)
+
+                if weighting in RANKING_FUNCTIONS:
+                    self.log(f"Calculating {weighting} scores...")
+                elif method == "cosine":
+                    self.log(f"Calculating Cosine similarity with {weighting} weighting...")
+                else:  # Euclidean distance
+                    self.log(f"Calculating Euclidean distance with {weighting} weighting...")
+                top_ratings = self.topDocuments(queryVector, method, weighting, k)
+                if cache is not None:
+                    cache.put(key, tuple(top_ratings), self.version)
+        instrumentation.count("queries")
+
+        self.printResults(top_ratings, file_paths)
+        return top_ratings
+
+    def printResults(self, top_ratings, file_paths):
+        """Print (index, score) pairs as file name and score, if file_paths given"""
+        if not file_paths:
+            return
+        print("\nNewsID Score")
         for index, score in top_ratings:
             # print(f"索引: {index}, file_paths 長度: {len(file_paths)}")
             file_name = os.path.basename(file_paths[index])
             print(f"{file_name}  {score:.7f}")
-
-        return top_ratings
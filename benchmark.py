@@ -0,0 +1,631 @@
+"""Benchmarks for the search pipeline.
+
+Usage:
+    python benchmark.py parser --news_dir ./EnglishNews
+    python benchmark.py chinese --chi_news_dir ./ChineseNews
+    python benchmark.py suite --output benchmark.json
+    python benchmark.py server --concurrency 1,16,64
+    python benchmark.py pruning --scale 4
+
+The suite times the index build phase by phase, single-query search
+latency, batch throughput, pseudo feedback and the evaluation on the
+bundled corpora and on synthetic corpora scaled up from EnglishNews. The
+results are written as JSON so that runs on different commits can be
+compared. The server benchmark drives SearchServer over loopback with
+keep-alive clients, and the pruning benchmark compares MaxScore top-k
+retrieval with scoring every document.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import time
+
+import numpy as np
+from nltk.tokenize import word_tokenize
+
+from DocumentLoader import iter_documents, list_documents
+from Instrumentation import Instrumentation, peakRss
+from Parser import CJK, Parser, jiebaModule, loadStopwords
+from PorterStemmer import PorterStemmer
+
+# Percentiles reported for single-query latency
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# Share of the words of a synthetic document replaced by a variant spelling
+# (see synthetic_corpus)
+SYNTHETIC_VARIANT_RATE = 0.2
+
+# Chinese query words: jieba words of two or more CJK characters
+CJK_WORD = re.compile(f"[{CJK}]{{2,}}")
+
+
+def read_news(news_dir, limit=None):
+    """Read News*.txt files in id order, skipping empty ones."""
+    file_paths = list_documents(news_dir)[:limit]
+    return [text for _, _, text in iter_documents(file_paths)]
+
+
+def best_time(function, repeat):
+    """Best wall time of several runs of function()."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def legacy_english_tokenise(documents):
+    """English preprocessing as Parser did it before the fast path.
+
+    Stopwords in a list, an uncompiled regex per call, no stem cache, and
+    every token stemmed before the stemmed form is checked against the list.
+    """
+    stemmer = PorterStemmer()
+    stopwords = list(loadStopwords("english.stop"))
+
+    results = []
+    for text in documents:
+        text = text.replace(".", "")
+        text = re.sub(r"\s+", " ", text).lower()
+        words = [stemmer.stem(word, 0, len(word) - 1) for word in word_tokenize(text)]
+        results.append([word for word in words if word not in stopwords])
+    return results
+
+
+def benchmark_parser(documents, repeat=3):
+    """Compare tokens/sec of the legacy and current English preprocessing."""
+    tokens = sum(len(word_tokenize(Parser().clean(text))) for text in documents)
+
+    def current():
+        # A fresh Parser per run, so the stem cache starts cold every time
+        parser = Parser()
+        return [parser.english_tokenise(text) for text in documents]
+
+    legacy_seconds = best_time(lambda: legacy_english_tokenise(documents), repeat)
+    current_seconds = best_time(current, repeat)
+    return {
+        "documents": len(documents),
+        "tokens": tokens,
+        "legacy_seconds": legacy_seconds,
+        "legacy_tokens_per_sec": tokens / legacy_seconds,
+        "seconds": current_seconds,
+        "tokens_per_sec": tokens / current_seconds,
+        "speedup": legacy_seconds / current_seconds,
+    }
+
+
+@contextlib.contextmanager
+def quietly():
+    """Swallow the prints and tqdm bars of the code being timed"""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+        io.StringIO()
+    ):
+        yield
+
+
+def environment():
+    """Commit, interpreter and machine the results were measured on"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def synthetic_corpus(documents, scale, seed=0):
+    """Scale a corpus up by resampling it: len(documents) * scale documents.
+
+    Each synthetic document is a randomly chosen real document with its words
+    shuffled, so document lengths and the term distribution stay realistic.
+    SYNTHETIC_VARIANT_RATE of its words get one of about sqrt(scale) variant
+    suffixes, which makes the vocabulary grow with the square root of the
+    corpus (Heaps' law) and gives the new terms postings of their own.
+    Documents are generated lazily, so the corpus never sits in memory.
+    """
+    rng = random.Random(seed)
+    variants = max(1, round(scale**0.5))
+    for _ in range(len(documents) * scale):
+        words = rng.choice(documents).split()
+        rng.shuffle(words)
+        for position in range(len(words)):
+            if words[position].isalpha() and rng.random() < SYNTHETIC_VARIANT_RATE:
+                words[position] += "x" * rng.randint(1, variants)
+        yield " ".join(words)
+
+
+def query_words(document, language="english"):
+    """Words of a document that make sensible query terms.
+
+    Alphabetic words for English; for Chinese the jieba words of two or more
+    CJK characters, since splitting on whitespace leaves mostly Latin tokens.
+    """
+    if language.startswith("chinese"):
+        return [word for word in jiebaModule().cut(document) if CJK_WORD.fullmatch(word)]
+    return [word for word in document.split() if word.isalpha()]
+
+
+def sample_queries(documents, count, seed=0, max_terms=3, language="english"):
+    """Queries of 1 to max_terms words picked from the documents themselves"""
+    rng = random.Random(seed)
+    queries = []
+    while len(queries) < count:
+        words = query_words(rng.choice(documents), language)
+        if words:
+            queries.append(rng.sample(words, min(len(words), rng.randint(1, max_terms))))
+    return queries
+
+
+def benchmark_build(documents, language="english"):
+    """Build a VectorSpace and report the phase timings its build records.
+
+    Returns (vectorSpace, result). build runs with workers=1 and an
+    Instrumentation of its own, without cProfile or tracemalloc, so the
+    phases are those of VectorSpace.build (warm_up, analyze, tf, idf,
+    tf_idf) and seconds is the whole build.
+    """
+    from VectorSpace import VectorSpace
+
+    instrumentation = Instrumentation(profile=False, traceMemory=False)
+    vectorSpace = VectorSpace(
+        documents, language=language, quiet=True, instrumentation=instrumentation
+    )
+    phases = {
+        name: totals["seconds"]
+        for name, totals in instrumentation.phases.items()
+        if name != "build"
+    }
+    seconds = instrumentation.phases["build"]["seconds"]
+
+    index = vectorSpace.index
+    return vectorSpace, {
+        "documents": index.numDocuments,
+        "terms": index.numTerms,
+        "postings": instrumentation.counts["postings"],
+        "index_bytes": int(index.nbytes()),
+        "peak_rss_bytes": peakRss(),
+        "phases": phases,
+        "seconds": seconds,
+        "documents_per_sec": index.numDocuments / max(seconds, 1e-9),
+    }
+
+
+def substring_queries(documents, count, seed=0):
+    """Segmentation-free Chinese queries: two CJK substrings of one document.
+
+    Each query has two 2-3 character pieces of a random document, so it is
+    fair to analysers with and without a dictionary.
+    """
+    from Parser import CJK_OR_WORD
+
+    rng = random.Random(seed)
+    queries = []
+    while len(queries) < count:
+        runs = [
+            match.group(1)
+            for match in CJK_OR_WORD.finditer(rng.choice(documents))
+            if match.group(1) and len(match.group(1)) >= 3
+        ]
+        if len(runs) < 2:
+            continue
+        query = []
+        for run in rng.sample(runs, 2):
+            length = rng.randint(2, 3)
+            start = rng.randrange(len(run) - length + 1)
+            query.append(run[start : start + length])
+        queries.append(query)
+    return queries
+
+
+def substring_relevance(documents, queries):
+    """Per query, the indices of documents containing every query piece"""
+    return [
+        {
+            index
+            for index, document in enumerate(documents)
+            if all(piece in document for piece in query)
+        }
+        for query in queries
+    ]
+
+
+def benchmark_chinese_analyzers(documents, num_queries=200, k=10):
+    """Build time, vocabulary and retrieval quality of each Chinese analyser.
+
+    Relevance is substring containment of every query piece (see
+    substring_queries), scored with the evaluation harness's metrics.
+    """
+    from Evaluation import calculate_metrics_at_k
+    from VectorSpace import CHINESE_ANALYZERS
+
+    queries = substring_queries(documents, num_queries)
+    relevance = substring_relevance(documents, queries)
+    results = {}
+    for language in CHINESE_ANALYZERS:
+        vectorSpace, build = benchmark_build(documents, language)
+        rankings = vectorSpace.search_batch(queries, k=k)
+        metrics = np.mean(
+            [
+                calculate_metrics_at_k(relevant, [index for index, _ in ranking], k)
+                for relevant, ranking in zip(relevance, rankings)
+            ],
+            axis=0,
+        )
+        results[language] = {
+            "build": build,
+            f"MRR@{k}": float(metrics[0]),
+            f"MAP@{k}": float(metrics[1]),
+            f"Recall@{k}": float(metrics[2]),
+        }
+    return results
+
+
+def benchmark_search(vectorSpace, queries, method="cosine", weighting="tf-idf"):
+    """Latency percentiles of single quiet search() calls, in milliseconds.
+
+    The queries run once with an empty result cache and then again, when
+    every one is a cache hit (the cached_ figures).
+    """
+    if vectorSpace.queryCache is not None:
+        vectorSpace.queryCache.invalidate(vectorSpace.version)
+
+    result = {"method": method, "weighting": weighting, "queries": len(queries)}
+    for prefix in ("", "cached_"):
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            vectorSpace.search(query, method, weighting)
+            latencies.append((time.perf_counter() - start) * 1000)
+        for percentile in LATENCY_PERCENTILES:
+            result[f"{prefix}p{percentile}_ms"] = float(
+                np.percentile(latencies, percentile)
+            )
+        result[f"{prefix}mean_ms"] = float(np.mean(latencies))
+    return result
+
+
+def benchmark_pruning(vectorSpace, queries, weighting="tf-idf", k=10, repeat=3):
+    """Top-k latency of MaxScore, the exhaustive product and topDocuments' choice.
+
+    Every query vector is timed (best of repeat) on each path, in
+    milliseconds; "auto" is what search() does, choosing per query with
+    maxScorePays.
+    """
+    queryVectors = [vectorSpace.makeQueryVector(query, weighting) for query in queries]
+    queryVectors = [queryVector for queryVector in queryVectors if queryVector]
+    vectorSpace.termUpperBounds(weighting)
+    pruning = vectorSpace.pruning
+
+    def exhaustive(queryVector):
+        vectorSpace.pruning = False
+        return vectorSpace.topDocuments(queryVector, "cosine", weighting, k)
+
+    def auto(queryVector):
+        vectorSpace.pruning = True
+        return vectorSpace.topDocuments(queryVector, "cosine", weighting, k)
+
+    paths = {
+        "maxscore": lambda queryVector: vectorSpace.maxScoreTopK(queryVector, weighting, k),
+        "exhaustive": exhaustive,
+        "auto": auto,
+    }
+    result = {"weighting": weighting, "k": k, "queries": len(queryVectors)}
+    try:
+        for name, path in paths.items():
+            latencies = [
+                best_time(lambda: path(queryVector), repeat) * 1000
+                for queryVector in queryVectors
+            ]
+            result[f"{name}_mean_ms"] = float(np.mean(latencies))
+            for percentile in LATENCY_PERCENTILES:
+                result[f"{name}_p{percentile}_ms"] = float(
+                    np.percentile(latencies, percentile)
+                )
+    finally:
+        vectorSpace.pruning = pruning
+    result["maxscore_share"] = float(
+        np.mean(
+            [
+                vectorSpace.maxScorePays(queryVector, weighting)
+                for queryVector in queryVectors
+            ]
+        )
+    )
+    result["speedup"] = result["exhaustive_mean_ms"] / max(result["auto_mean_ms"], 1e-9)
+    return result
+
+
+def benchmark_batch(vectorSpace, queries, method="cosine", weighting="tf-idf", k=10):
+    """Throughput of search_batch in queries per second"""
+    start = time.perf_counter()
+    vectorSpace.search_batch(queries, method, weighting, k)
+    seconds = time.perf_counter() - start
+    return {
+        "method": method,
+        "weighting": weighting,
+        "queries": len(queries),
+        "seconds": seconds,
+        "queries_per_sec": len(queries) / max(seconds, 1e-9),
+    }
+
+
+def benchmark_feedback(vectorSpace, query, documents):
+    """Wall time of one pseudo_feedback round per feedback mode"""
+    from Relevance_feedback import pseudo_feedback
+
+    file_paths = [""] * vectorSpace.index.numDocuments
+    results = {}
+    for mode in ("pos", "rocchio"):
+        start = time.perf_counter()
+        try:
+            with quietly():
+                pseudo_feedback(vectorSpace, query, documents, file_paths, mode)
+        except LookupError as e:  # NLTK tagger data not installed
+            results[mode] = {"error": str(e).strip("*\n ").splitlines()[0]}
+            continue
+        results[mode] = {"seconds": time.perf_counter() - start}
+    return {"query": query, **results}
+
+
+def benchmark_evaluation(base_path, weighting=None):
+    """Wall time and metrics of evaluate_ir_system on an evaluation set"""
+    from Evaluation import evaluate_ir_system
+
+    start = time.perf_counter()
+    with quietly():
+        metrics = evaluate_ir_system(
+            os.path.join(base_path, "queries"),
+            os.path.join(base_path, "collections"),
+            os.path.join(base_path, "rel.tsv"),
+            weighting,
+        )
+    return {
+        "weighting": weighting or "sklearn tf-idf",
+        "seconds": time.perf_counter() - start,
+        "metrics": metrics,
+    }
+
+
+async def loopback_client(host, port, queries):
+    """Send searches one after the other on one keep-alive connection"""
+    from urllib.parse import quote
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for query in queries:
+            writer.write(
+                f"GET /search?q={quote(query)} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode()
+            )
+            await writer.drain()
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = re.search(rb"content-length: *(\d+)", head, re.IGNORECASE)
+            await reader.readexactly(int(length.group(1)))
+    finally:
+        writer.close()
+
+
+async def run_server_benchmark(server, queries, concurrency):
+    """Spread queries over concurrency clients of a started server"""
+    host, port = server.address
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            loopback_client(host, port, queries[client::concurrency])
+            for client in range(concurrency)
+        )
+    )
+    return time.perf_counter() - start
+
+
+def benchmark_server(vectorSpace, queries, concurrency=(1, 16, 64), threads=None):
+    """Loopback throughput and server-side latency of SearchServer /search.
+
+    Each concurrency level gets a fresh server and an empty result cache,
+    so every query is scored.
+    """
+    from Searcher import Searcher
+    from SearchServer import SearchServer
+
+    searcher = Searcher(vectorSpace)
+    results = []
+    for clients in concurrency:
+        if vectorSpace.queryCache is not None:
+            vectorSpace.queryCache.invalidate(vectorSpace.version)
+        server = SearchServer(searcher, threads=threads)
+
+        async def run():
+            await server.start("127.0.0.1", 0)
+            try:
+                return await run_server_benchmark(server, queries, clients)
+            finally:
+                server.close()
+
+        seconds = asyncio.run(run())
+        results.append(
+            {
+                "concurrency": clients,
+                "queries": len(queries),
+                "queries_per_sec": len(queries) / max(seconds, 1e-9),
+                "latency": server.latency("/search").report(),
+                "batches": server.batcher.stats()["batches"],
+            }
+        )
+    return results
+
+
+def benchmark_corpus(documents, language, queries, feedback_query=None):
+    """Build, search, batch and (optionally) feedback results for one corpus"""
+    vectorSpace, build = benchmark_build(documents, language)
+    result = {"build": build, "search": [], "batch": []}
+    methods = [("cosine", "tf"), ("cosine", "tf-idf"), ("cosine", "bm25")]
+    if language == "english":
+        methods.append(("euclidean", "tf-idf"))
+    for method, weighting in methods:
+        result["search"].append(benchmark_search(vectorSpace, queries, method, weighting))
+        result["batch"].append(benchmark_batch(vectorSpace, queries, method, weighting))
+    result["pruning"] = [
+        benchmark_pruning(vectorSpace, queries, weighting)
+        for weighting in ("tf-idf", "bm25")
+    ]
+    if feedback_query is not None:
+        result["feedback"] = benchmark_feedback(vectorSpace, feedback_query, documents)
+    return result
+
+
+def benchmark_suite(news_dir, chi_news_dir, eval_dir, scales=(10, 100), num_queries=200):
+    """Run every benchmark and return one JSON-serialisable result"""
+    results = {"environment": environment(), "corpora": {}}
+
+    english = read_news(news_dir)
+    print(f"EnglishNews: {len(english)} documents", flush=True)
+    results["corpora"]["EnglishNews"] = benchmark_corpus(
+        english, "english", sample_queries(english, num_queries), "Typhoon Taiwan war"
+    )
+
+    chinese = read_news(chi_news_dir)
+    print(f"ChineseNews: {len(chinese)} documents", flush=True)
+    results["corpora"]["ChineseNews"] = benchmark_corpus(
+        chinese, "chinese", sample_queries(chinese, num_queries, language="chinese")
+    )
+    results["chinese_analyzers"] = benchmark_chinese_analyzers(chinese, num_queries)
+
+    # Queries come from the real documents, which the synthetic ones resample
+    queries = sample_queries(english, num_queries)
+    for scale in scales:
+        name = f"synthetic_{scale}x"
+        print(f"{name}: {len(english) * scale} documents", flush=True)
+        results["corpora"][name] = benchmark_corpus(
+            synthetic_corpus(english, scale), "english", queries
+        )
+
+    print("smaller_dataset evaluation", flush=True)
+    results["evaluation"] = [
+        benchmark_evaluation(eval_dir, weighting) for weighting in (None, "bm25")
+    ]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search pipeline benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_bench = subparsers.add_parser(
+        "parser", help="English preprocessing throughput, legacy vs current."
+    )
+    parser_bench.add_argument("--news_dir", type=str, default="./EnglishNews")
+    parser_bench.add_argument(
+        "--limit", type=int, default=None, help="Only use the first N documents."
+    )
+    parser_bench.add_argument("--repeat", type=int, default=3)
+
+    chinese_bench = subparsers.add_parser(
+        "chinese", help="jieba vs bigram vs mixed Chinese analysers."
+    )
+    chinese_bench.add_argument("--chi_news_dir", type=str, default="./ChineseNews")
+    chinese_bench.add_argument("--queries", type=int, default=200)
+
+    suite = subparsers.add_parser(
+        "suite", help="Build, search, feedback and evaluation timings as JSON."
+    )
+    suite.add_argument("--news_dir", type=str, default="./EnglishNews")
+    suite.add_argument("--chi_news_dir", type=str, default="./ChineseNews")
+    suite.add_argument("--eval_dir", type=str, default="./smaller_dataset")
+    suite.add_argument(
+        "--scales",
+        type=lambda value: [int(scale) for scale in value.split(",") if scale],
+        default=[10, 100],
+        help="Comma-separated scale factors of the synthetic corpora.",
+    )
+    suite.add_argument("--queries", type=int, default=200)
+    suite.add_argument("--output", type=str, default="benchmark.json")
+
+    server_bench = subparsers.add_parser(
+        "server", help="SearchServer throughput and latency over loopback."
+    )
+    server_bench.add_argument("--news_dir", type=str, default="./EnglishNews")
+    server_bench.add_argument("--queries", type=int, default=1000)
+    server_bench.add_argument(
+        "--concurrency",
+        type=lambda value: [int(clients) for clients in value.split(",") if clients],
+        default=[1, 16, 64],
+        help="Comma-separated numbers of concurrent clients.",
+    )
+    server_bench.add_argument("--threads", type=int, default=None)
+
+    pruning_bench = subparsers.add_parser(
+        "pruning", help="MaxScore vs exhaustive top-k latency."
+    )
+    pruning_bench.add_argument("--news_dir", type=str, default="./EnglishNews")
+    pruning_bench.add_argument("--queries", type=int, default=300)
+    pruning_bench.add_argument(
+        "--scale",
+        type=int,
+        default=1,
+        help="Index a synthetic corpus this many times the size of the news.",
+    )
+
+    args = parser.parse_args()
+
+    if args.benchmark == "parser":
+        documents = read_news(args.news_dir, args.limit)
+        result = benchmark_parser(documents, args.repeat)
+        print(json.dumps(result, indent=2))
+    elif args.benchmark == "chinese":
+        result = benchmark_chinese_analyzers(read_news(args.chi_news_dir), args.queries)
+        print(json.dumps(result, indent=2))
+    elif args.benchmark == "server":
+        from VectorSpace import VectorSpace
+
+        documents = read_news(args.news_dir)
+        with quietly():
+            vectorSpace = VectorSpace(documents, quiet=True)
+        queries = sample_queries(documents, args.queries)
+        result = benchmark_server(
+            vectorSpace, [" ".join(query) for query in queries], args.concurrency, args.threads
+        )
+        print(json.dumps(result, indent=2))
+    elif args.benchmark == "pruning":
+        from VectorSpace import VectorSpace
+
+        documents = read_news(args.news_dir)
+        queries = sample_queries(documents, args.queries)
+        if args.scale > 1:
+            documents = synthetic_corpus(documents, args.scale)
+        vectorSpace = VectorSpace(documents, quiet=True)
+        result = [
+            benchmark_pruning(vectorSpace, queries, weighting)
+            for weighting in ("tf", "tf-idf", "bm25")
+        ]
+        print(json.dumps(result, indent=2))
+    elif args.benchmark == "suite":
+        result = benchmark_suite(
+            args.news_dir,
+            args.chi_news_dir,
+            args.eval_dir,
+            args.scales,
+            args.queries,
+        )
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,116 @@
-import glob
+import hashlib
 import os
 import argparse
-from VectorSpace import VectorSpace
-from Evaluation import evaluate_ir_system
-from Relevance_feedback import pseudo_feedback  # Import the pseudo_feedback function
+from DocumentLoader import LazyDocuments, iter_documents, list_documents
+from Instrumentation import QUIET_ENV, Instrumentation, envFlag
 
+# VectorSpace, Evaluation and Relevance_feedback pull in numpy/scipy, nltk,
+# jieba, pandas and scikit-learn, so each command imports only what it uses.
+
+# Where the index, search and feedback commands keep their saved indexes
+DEFAULT_INDEX_DIR = "./index"
+
+# --chinese-analyzer value -> VectorSpace language
+CHINESE_LANGUAGES = {
+    "jieba": "chinese",
+    "bigram": "chinese-bigram",
+    "mixed": "chinese-mixed",
+}
 
-def load_documents(news_dir):
-    """Load news documents from the specified directory."""
-    news_files = sorted(
-        glob.glob(os.path.join(news_dir, "News*.txt")),
-        key=lambda x: int(x.split("News")[-1].split(".")[0]),
-    )
-    print(f"Found {len(news_files)} documents")
 
-    documents = []
+def load_documents(news_files):
+    """Stream news documents from the given files.
+
+    Returns (documents, file_paths): documents is a generator that reads one
+    file at a time, and file_paths fills up with the path of every document
+    as it is yielded (empty files are skipped).
+    """
     file_paths = []
 
-    for file_path in news_files:
+    def documents():
+        for _, file_path, content in iter_documents(news_files):
+            file_paths.append(file_path)
+            yield content
+
+    return documents(), file_paths
+
+
+def positive_int(text):
+    """argparse type of counts that must be at least 1"""
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return value
+
+
+def corpus_fingerprint(file_paths):
+    """Fingerprint a document set from its file names, sizes and modification times."""
+    digest = hashlib.sha1()
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        digest.update(
+            f"{os.path.basename(file_path)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode()
+        )
+    return digest.hexdigest()
+
+
+def load_vector_space(
+    news_dir, language, index_dir=None, workers=1, quiet=None, instrumentation=None
+):
+    """Build the vector space for a news directory, streaming the files.
+
+    With index_dir, the index saved there is reused while the corpus is
+    unchanged, without reading any document. quiet and instrumentation are
+    passed on to the VectorSpace; quiet also silences the loading messages.
+    Returns (vectorSpace, file_paths).
+    """
+    from VectorSpace import VectorSpace
+
+    silent = envFlag(QUIET_ENV) if quiet is None else quiet
+    log = (lambda message: None) if silent else print
+    news_files = list_documents(news_dir)
+    log(f"Found {len(news_files)} documents")
+
+    if index_dir is not None:
+        path = os.path.join(index_dir, language)
+        fingerprint = corpus_fingerprint(news_files)
         try:
-            with open(file_path, "r", encoding="utf-8") as file:
-                content = file.read().strip()
-                if content:
-                    documents.append(content)
-                    file_paths.append(file_path)
-                else:
-                    print(f"Warning: Empty document {file_path} skipped.")
-        except Exception as e:
-            print(f"Error reading {file_path}: {e}")
+            manifest = VectorSpace.readManifest(path)
+            if manifest["metadata"].get("fingerprint") == fingerprint:
+                log(f"Loading {language} index from {path}")
+                vectorSpace = VectorSpace.load(path)
+                if quiet is not None:
+                    vectorSpace.quiet = quiet
+                vectorSpace.warmUp()  # Before queries, so quiet applies to jieba
+                if instrumentation is not None:
+                    vectorSpace.instrumentation = instrumentation
+                file_paths = [
+                    os.path.join(news_dir, file_name)
+                    for file_name in vectorSpace.metadata["documents"]
+                ]
+                return vectorSpace, file_paths
+            log(f"Corpus changed since {path} was built, rebuilding...")
+        except (OSError, ValueError, KeyError) as e:
+            log(f"No usable index in {path} ({e}), building...")
+
+    documents, file_paths = load_documents(news_files)
+    vectorSpace = VectorSpace(
+        documents,
+        language=language,
+        workers=workers,
+        quiet=quiet,
+        instrumentation=instrumentation,
+    )
 
-    return documents, file_paths
+    if index_dir is not None:
+        vectorSpace.save(
+            path,
+            metadata={
+                "fingerprint": fingerprint,
+                "documents": [os.path.basename(p) for p in file_paths],
+            },
+        )
+    return vectorSpace, file_paths
 
 
 def perform_vsm_search(vectorSpace, query, file_paths, language):
@@ -60,10 +141,15 @@ def perform_vsm_search(vectorSpace, query, file_paths, language):
         )
 
 
-def task2(vectorSpace, original_query, documents, file_paths):
+def task2(vectorSpace, original_query, documents, file_paths, mode="pos"):
     """Task 2: Perform Pseudo Feedback and re-rank documents."""
+    from Relevance_feedback import pseudo_feedback
+
     print(f"\nTask 2: Performing Pseudo Feedback for query: {original_query}")
-    pseudo_feedback(vectorSpace, original_query, documents, file_paths)
+    try:
+        pseudo_feedback(vectorSpace, original_query, documents, file_paths, mode)
+    except LookupError as e:  # NLTK data not installed on this host
+        print(f"Skipping pseudo feedback: {e}")
 
     # if re_ranked_results:
 
@@ -76,20 +162,26 @@ def task2(vectorSpace, original_query, documents, file_paths):
     #     print("No results found after Pseudo Feedback.")
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Document Search and Evaluation System"
-    )
+def add_common_arguments(parser, suppress=False):
+    """Options accepted before or after any command.
+
+    With suppress, unset options are left out of the namespace, so that a
+    subcommand does not reset values already parsed by the main parser.
+    """
+
+    def add(*names, **kwargs):
+        if suppress:
+            kwargs["default"] = argparse.SUPPRESS
+        parser.add_argument(*names, **kwargs)
 
     # 設定預設的新聞資料夾
-    parser.add_argument(
+    add(
         "--Eng_news_dir",
         type=str,
         default="./EnglishNews",  # 預設的英文新聞資料夾路徑
         help="Directory containing the English news files.",
     )
-
-    parser.add_argument(
+    add(
         "--Chi_news_dir",
         type=str,
         default="./ChineseNews",  # 預設的中文新聞資料夾路徑
@@ -97,14 +189,13 @@ def main():
     )
 
     # 設定預設查詢字串
-    parser.add_argument(
+    add(
         "--Eng_query",
         type=str,
         default="Typhoon Taiwan war",  # 預設的查詢字串
         help="Query for document search.",
     )
-
-    parser.add_argument(
+    add(
         "--Chi_query",
         type=str,
         default="資安 遊戲",
@@ -112,22 +203,246 @@ def main():
     )
 
     # 設定預設的評估檔案路徑
-    parser.add_argument(
+    add(
         "--base_path",
         type=str,
         default="./smaller_dataset",  # 預設的評估檔案路徑
         help="Base path for evaluation files (queries, collections, rel.tsv).",
     )
+    add(
+        "--index-dir",
+        type=str,
+        default=None,
+        help="Directory for saved indexes; reused while the news corpus is "
+        f"unchanged (index, search and feedback default to {DEFAULT_INDEX_DIR}).",
+    )
+    add(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes used to tokenise documents while building an index.",
+    )
+    add(
+        "--chinese-analyzer",
+        choices=list(CHINESE_LANGUAGES),
+        default="jieba",
+        help="Index Chinese news by jieba words, CJK character bigrams, or both.",
+    )
+    add(
+        "--quiet",
+        action="store_true",
+        default=None,
+        help="Silence the progress bars and messages of index builds and searches.",
+    )
+    add(
+        "--profile",
+        type=str,
+        default=None,
+        metavar="JSON",
+        help="Profile index builds and searches with cProfile and write the "
+        "timings, counts and profiles to this file (VSM_PROFILE=1 writes profile.json).",
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Document Search and Evaluation System. Without a command, "
+        "runs every task (search, feedback, Chinese search, evaluation)."
+    )
+    add_common_arguments(parser)
+    subparsers = parser.add_subparsers(dest="command")
+
+    index = subparsers.add_parser("index", help="Build and save the news indexes.")
+    index.add_argument(
+        "--language", choices=["english", "chinese", "all"], default="all"
+    )
+
+    search = subparsers.add_parser("search", help="Search the news with one query.")
+    search.add_argument("--language", choices=["english", "chinese"], default="english")
+    search.add_argument(
+        "--query", type=str, default=None, help="Defaults to --Eng_query/--Chi_query."
+    )
+    search.add_argument(
+        "--method",
+        choices=["cosine", "euclidean"],
+        default=None,
+        help="Run one scheme (default cosine, tf-idf) instead of all of Task 1's.",
+    )
+    search.add_argument(
+        "--weighting",
+        choices=["tf", "tf-idf", "bm25", "bm25+", "pivoted"],
+        default=None,
+    )
+    search.add_argument("-k", type=positive_int, default=10)
+
+    feedback = subparsers.add_parser(
+        "feedback", help="Pseudo relevance feedback for an English query."
+    )
+    feedback.add_argument(
+        "--query", type=str, default=None, help="Defaults to --Eng_query."
+    )
+    feedback.add_argument(
+        "--mode",
+        choices=["pos", "rocchio"],
+        default="pos",
+        help="Re-query with the top document's nouns and verbs, or expand the "
+        "query vector with Rocchio.",
+    )
+
+    evaluate = subparsers.add_parser(
+        "evaluate", help="MRR/MAP/Recall@10 on the evaluation set."
+    )
+    evaluate.add_argument(
+        "--weighting",
+        choices=["tf", "tf-idf", "bm25", "bm25+", "pivoted"],
+        default=None,
+        help="Rank with VectorSpace instead of scikit-learn TF-IDF.",
+    )
+    for name, help in (
+        ("--k1", "BM25 term frequency saturation."),
+        ("--b", "BM25 length normalisation."),
+        ("--delta", "BM25+ lower bound of a matching term's weight."),
+        ("--slope", "Pivoted normalisation slope."),
+    ):
+        evaluate.add_argument(
+            name, type=float, default=None, help=f"{help} Needs --weighting."
+        )
+
+    serve = subparsers.add_parser(
+        "serve", help="HTTP search service over a saved index (see SearchServer.py)."
+    )
+    serve.add_argument("--language", choices=["english", "chinese"], default="english")
+    serve.add_argument("--host", type=str, default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Threads scoring queries (default: one per CPU).",
+    )
+    serve.add_argument(
+        "--batch-window",
+        type=float,
+        default=0.0,
+        metavar="MS",
+        help="Milliseconds a search waits for others to be scored with it.",
+    )
+
+    for subparser in (index, search, feedback, evaluate, serve):
+        add_common_arguments(subparser, suppress=True)
+    return parser
+
+
+def news_vector_space(args, language, instrumentation, index_dir=None):
+    """Load or build the English or Chinese news vector space for a command"""
+    if language == "english":
+        news_dir, vsm_language = args.Eng_news_dir, "english"
+    else:
+        news_dir, vsm_language = args.Chi_news_dir, CHINESE_LANGUAGES[args.chinese_analyzer]
+    return load_vector_space(
+        news_dir,
+        vsm_language,
+        index_dir,
+        args.workers,
+        args.quiet,
+        instrumentation,
+    )
 
-    args = parser.parse_args()
 
+def run_index(args, instrumentation):
+    """index: build (or refresh) the saved indexes"""
+    index_dir = args.index_dir or DEFAULT_INDEX_DIR
+    languages = ["english", "chinese"] if args.language == "all" else [args.language]
+    for language in languages:
+        vectorSpace, file_paths = news_vector_space(
+            args, language, instrumentation, index_dir
+        )
+        print(
+            f"{language}: {len(file_paths)} documents, "
+            f"{len(vectorSpace.vectorKeywordIndex)} terms in {index_dir}"
+        )
+
+
+def run_search(args, instrumentation):
+    """search: one query against a saved (or freshly built) index"""
+    vectorSpace, file_paths = news_vector_space(
+        args, args.language, instrumentation, args.index_dir or DEFAULT_INDEX_DIR
+    )
+    query = args.query or (
+        args.Eng_query if args.language == "english" else args.Chi_query
+    )
+    if args.method is None and args.weighting is None:
+        perform_vsm_search(vectorSpace, query, file_paths, args.language)
+    else:
+        vectorSpace.search(
+            query.split(),
+            method=args.method or "cosine",
+            weighting=args.weighting or "tf-idf",
+            file_paths=file_paths,
+            k=args.k,
+        )
+
+
+def run_feedback(args, instrumentation):
+    """feedback: Task 2 on the English news"""
+    vectorSpace, file_paths = news_vector_space(
+        args, "english", instrumentation, args.index_dir or DEFAULT_INDEX_DIR
+    )
+    task2(
+        vectorSpace,
+        args.query or args.Eng_query,
+        LazyDocuments(file_paths),
+        file_paths,
+        args.mode,
+    )
+
+
+def run_evaluate(args, weighting=None):
+    """evaluate: Task 4"""
+    from Evaluation import evaluate_ir_system
+
+    queries_path = os.path.join(args.base_path, "queries")
+    collections_path = os.path.join(args.base_path, "collections")
+    rel_file = os.path.join(args.base_path, "rel.tsv")
+    params = {
+        name: getattr(args, name)
+        for name in ("k1", "b", "delta", "slope")
+        if getattr(args, name, None) is not None
+    }
+    evaluate_ir_system(
+        queries_path, collections_path, rel_file, weighting, quiet=args.quiet, **params
+    )
+
+
+def run_serve(args, instrumentation):
+    """serve: answer search, related and feedback requests over HTTP"""
+    from Searcher import Searcher
+    from SearchServer import serve
+
+    vectorSpace, file_paths = news_vector_space(
+        args, args.language, instrumentation, args.index_dir or DEFAULT_INDEX_DIR
+    )
+    vectorSpace.quiet = True
+    serve(
+        Searcher(vectorSpace),
+        [os.path.basename(file_path) for file_path in file_paths],
+        args.host,
+        args.port,
+        args.threads,
+        args.batch_window / 1000,
+    )
+
+
+def run_all(args, instrumentation):
+    """No command: every task, as the course project runs them"""
     # Load documents
     print("Task 1: VSM with Different Weighting Schemes & Similarity Metrics")
-    eng_documents, eng_file_paths = load_documents(args.Eng_news_dir)
-
     # 建立 VectorSpace 物件並建構向量空間
     print("Building Task 1 vector space...")
-    engVectorSpace = VectorSpace(eng_documents, language="english")
+    engVectorSpace, eng_file_paths = news_vector_space(
+        args, "english", instrumentation, args.index_dir
+    )
+    eng_documents = LazyDocuments(eng_file_paths)
 
     #
     if args.Eng_query:
@@ -141,10 +456,10 @@ def main():
     print(
         "Task 3: VSM with Different Scheme & Similarity Metrics in Chinese and English"
     )
-    chi_documents, chi_file_paths = load_documents(args.Chi_news_dir)
-
     print("Building Task 3 vector space...")
-    chiVectorSpace = VectorSpace(chi_documents, language="chinese")
+    chiVectorSpace, chi_file_paths = news_vector_space(
+        args, "chinese", instrumentation, args.index_dir
+    )
 
     # 中文查詢
     if args.Chi_query:
@@ -154,11 +469,30 @@ def main():
 
     # 執行評估
     print("\nRunning full evaluation...")
-    queries_path = os.path.join(args.base_path, "queries")
-    collections_path = os.path.join(args.base_path, "collections")
-    rel_file = os.path.join(args.base_path, "rel.tsv")
+    run_evaluate(args)  # Task 4
 
-    evaluate_ir_system(queries_path, collections_path, rel_file)  # Task 4
+
+def main():
+    args = build_parser().parse_args()
+    instrumentation = Instrumentation(profile=True if args.profile else None)
+
+    if args.command == "index":
+        run_index(args, instrumentation)
+    elif args.command == "search":
+        run_search(args, instrumentation)
+    elif args.command == "feedback":
+        run_feedback(args, instrumentation)
+    elif args.command == "evaluate":
+        run_evaluate(args, args.weighting)
+    elif args.command == "serve":
+        run_serve(args, instrumentation)
+    else:
+        run_all(args, instrumentation)
+
+    if args.profile or instrumentation.profile:
+        profile_path = args.profile or "profile.json"
+        instrumentation.save(profile_path)
+        print(f"Instrumentation written to {profile_path}")
 
 
 if __name__ == "__main__":
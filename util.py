@@ -1,4 +1,6 @@
 import sys
+from collections import deque
+from itertools import islice
 
 import numpy as np
 
@@ -35,3 +37,45 @@ def cosine(vector1, vector2):
     except Exception as e:
         print(f"Error in cosine similarity calculation: {e}")
         return 0.0
+
+
+def top_k(ratings, k, largest=True):
+    """Return the indices of the k best ratings, best first.
+
+    Uses argpartition instead of a full sort; ties keep index order, like a
+    stable sort of the whole array would.
+    """
+    keys = -ratings if largest else ratings
+    if k < len(keys):
+        best = np.argpartition(keys, k - 1)[:k]
+        candidates = np.flatnonzero(keys <= keys[best].max())
+    else:
+        candidates = np.arange(len(keys))
+    order = np.lexsort((candidates, keys[candidates]))
+    return candidates[order[:k]]
+
+
+def chunked(iterable, size):
+    """Yield lists of up to size consecutive items from any iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bounded_map(executor, function, iterable, window):
+    """Like executor.map, but with at most window calls in flight.
+
+    executor.map submits everything up front, which would pull a lazy input
+    fully into memory; this consumes the input only as results are taken.
+    Results come back in input order.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()